@@ -28,6 +28,7 @@ Requires:       python3dist(requests)
 Requires:       python3dist(setuptools)
 Requires:       python3dist(flask)
 Requires:       python3dist(flask-basicauth)
+Requires:       python3dist(waitress)
 
 BuildRequires:     systemd
 Requires(post):    systemd
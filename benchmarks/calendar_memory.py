@@ -0,0 +1,143 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Memory benchmark for cached calendars.
+
+Loads synthetic calendars into a number of agents and reports the memory used
+per event and the total resident memory of the process. For comparison, the
+same events are also stored as list of plain Python objects like it was done
+before the introduction of the event store.
+
+Run this from the repository root::
+
+    PYTHONPATH=. python benchmarks/calendar_memory.py [agents] [days]
+'''
+
+import argparse
+import gc
+import resource
+import time
+import tracemalloc
+
+from typing import Any
+
+from occameracontrol import clock
+from occameracontrol.agent import Agent, parse_date
+
+
+class PlainEvent:
+    '''Event object with a `__dict__` as used before.
+    '''
+
+    def __init__(self, title: str, start: float, end: float):
+        self.title = title
+        self.start = start
+        self.end = end
+
+
+def synthetic_calendar(agent_id: str, start: int, days: int) -> list[dict]:
+    '''Create calendar data with four weekly recurring lectures per weekday.
+    '''
+    calendar = []
+    for day in range(days):
+        if day % 7 >= 5:
+            continue
+        for slot in range(4):
+            event_start = start + day * 86400 + (8 + slot * 2) * 3600
+            calendar.append({'data': {
+                'startDate': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                           time.gmtime(event_start)),
+                'endDate': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                         time.gmtime(event_start + 5400)),
+                'agentConfig': {
+                    # Titles are created for each event, like when parsing
+                    # the JSON data from Opencast.
+                    'event.title': ''.join(('Lecture ', agent_id,
+                                            f' {day % 7}-{slot}')),
+                    'event.location': agent_id}}})
+    return calendar
+
+
+def rss() -> float:
+    '''Returns the current resident set size in MiB, or the peak resident set
+    size if the current one is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def measure(name: str, load) -> Any:
+    '''Measure the memory allocated by the objects created by `load`.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    data, events = load()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<14} {events:10,} events {size / 2**20:10.1f} MiB '
+          f'{size / events:8.1f} bytes/event')
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calendar memory benchmark')
+    parser.add_argument('agents', type=int, nargs='?', default=500,
+                        help='Number of agents (default: 500)')
+    parser.add_argument('days', type=int, nargs='?', default=90,
+                        help='Calendar cutoff in days (default: 90)')
+    args = parser.parse_args()
+    agent_ids = [f'agent-{i}' for i in range(args.agents)]
+    start = int(time.time()) // 86400 * 86400
+    # The event store drops events which already ended. Pin the clock to
+    # the start of the calendar so that both representations hold the same
+    # events.
+    clock.set_clock(clock.VirtualClock(start))
+
+    def load_plain():
+        events = {}
+        for agent_id in agent_ids:
+            events[agent_id] = [
+                PlainEvent(data['agentConfig']['event.title'],
+                           parse_date(data['startDate']),
+                           parse_date(data['endDate']))
+                for data in (event['data'] for event in
+                             synthetic_calendar(agent_id, start, args.days))]
+        return events, sum(len(e) for e in events.values())
+
+    def load_store():
+        agents = []
+        for agent_id in agent_ids:
+            agent = Agent(agent_id)
+            agent.set_events(
+                synthetic_calendar(agent_id, start, args.days), b'')
+            agents.append(agent)
+        return agents, sum(len(a.events) for a in agents)
+
+    print(f'Loading calendars of {args.agents} agents '
+          f'for {args.days} days')
+    plain = measure('plain objects', load_plain)
+    del plain
+    agents = measure('event store', load_store)
+    print(f'Resident memory: {rss():.1f} MiB for {len(agents)} agents')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Micro-benchmark for parsing Opencast calendars.
+
+Parses a synthetic calendar and reports the events per second for parsing
+dates with `dateutil` only, for the fast path with an empty cache and for the
+fast path with a warm cache like it is the case for repeated calendar updates.
+
+Run this from the repository root::
+
+    PYTHONPATH=. python benchmarks/calendar_parsing.py [number of events]
+'''
+
+import argparse
+import time
+
+from dateutil.parser import parse
+
+from occameracontrol.agent import Agent, Event, parse_date
+
+
+def synthetic_calendar(count: int) -> list[dict]:
+    '''Create calendar data with `count` events, starting every 30 minutes.
+    '''
+    start = int(time.time()) // 1800 * 1800
+    calendar = []
+    for i in range(count):
+        event_start = start + i * 1800
+        calendar.append({'data': {
+            'startDate': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                       time.gmtime(event_start)),
+            'endDate': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                     time.gmtime(event_start + 1500)),
+            'agentConfig': {'event.title': f'Event {i}',
+                            'event.location': 'benchmark'}}})
+    return calendar
+
+
+def parse_calendar_dateutil(calendar: list[dict]) -> list[Event]:
+    '''Parse the calendar using `dateutil` for all dates.
+    '''
+    events = []
+    for event in calendar:
+        data = event['data']
+        title = data['agentConfig']['event.title']
+        start = parse(data['startDate'], dayfirst=True).timestamp()
+        end = parse(data['endDate'], dayfirst=True).timestamp()
+        events.append(Event(title, start, end))
+    return sorted(events, key=lambda e: e.start)
+
+
+def measure(name: str, count: int, function, setup=None, repeat: int = 3):
+    '''Run a function several times and print the best result.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    print(f'{name:<24} {best * 1000:10.1f} ms {count / best:14,.0f} events/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calendar parsing benchmark')
+    parser.add_argument('events', type=int, nargs='?', default=10000,
+                        help='Number of events (default: 10000)')
+    count = parser.parse_args().events
+
+    calendar = synthetic_calendar(count)
+    agent = Agent('benchmark')
+
+    print(f'Parsing a calendar with {count} events')
+    measure('dateutil', count, lambda: parse_calendar_dateutil(calendar))
+    measure('fast path (cold cache)', count,
+            lambda: agent.parse_calendar(calendar),
+            setup=parse_date.cache_clear)
+    measure('fast path (warm cache)', count,
+            lambda: agent.parse_calendar(calendar))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Replay a recorded schedule against simulated cameras.
+
+Loads the calendars from a calendar snapshot and runs the camera control
+logic for the whole time span covered by the events with a virtual clock,
+1000 times faster than real time by default. Commands are sent to simulated
+cameras instead of the network. Reports how many requests and commands the
+cameras received, how many commands were redundant since the camera was in
+the requested state already and how often each camera moved. This allows
+comparing the traffic caused by configuration or scheduling changes offline.
+
+Run this from the repository root::
+
+    PYTHONPATH=. python benchmarks/replay.py -c camera-control.yml [snapshot]
+'''
+
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import requests
+import sys
+import time
+
+from confygure import setup, config_t, config_rt
+from requests.adapters import BaseAdapter
+from urllib.parse import parse_qs, urlparse
+
+from occameracontrol.agent import Agent
+from occameracontrol.camera import Camera
+from occameracontrol.clock import VirtualClock, set_clock
+from occameracontrol.snapshot import CalendarSnapshot
+
+from simulator import SimulatedCamera
+
+
+class SimulatedCameraAdapter(BaseAdapter):
+    '''Transport adapter for `requests` sessions answering requests with a
+    simulated camera instead of sending them over the network::
+
+        session.mount('http://', SimulatedCameraAdapter(camera, url))
+    '''
+
+    def __init__(self, camera: SimulatedCamera, url: str):
+        '''Create a SimulatedCameraAdapter instance.
+
+        :param camera: Simulated camera to handle the requests
+        :param url: Base URL of the camera
+        '''
+        super().__init__()
+        self.camera = camera
+        self.path = urlparse(url).path.rstrip('/')
+
+    def send(self, request, *args, **kwargs):
+        '''Handle the request with the simulated camera.
+        '''
+        url = urlparse(request.url)
+        path = url.path[len(self.path):].lstrip('/')
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        try:
+            body = self.camera.handle(path, parse_qs(url.query))
+            response.status_code = 200
+            response._content = body.encode()
+        except LookupError:
+            response.status_code = 404
+            response._content = b''
+        return response
+
+    def close(self):
+        pass
+
+
+def next_reset(after: float) -> float:
+    '''Returns the first daily reset to automatic control after a point in
+    time.
+    '''
+    reset_time = datetime.time.fromisoformat(config_rt(str, 'reset_time'))
+    after_dt = datetime.datetime.fromtimestamp(after)
+    reset = datetime.datetime.combine(after_dt.date(), reset_time)
+    if reset <= after_dt:
+        reset += datetime.timedelta(days=1)
+    return reset.timestamp()
+
+
+def replay(cameras: list[Camera], clock: VirtualClock, end: float,
+           speed: float):
+    '''Run the control logic of all cameras until `end`. Every camera is
+    handled at the times its control loop would wake up: when a preset needs
+    to be re-sent, when the state of its agent changes and at the daily
+    reset. Queued commands are sent right away.
+
+    :param cameras: Cameras to control
+    :param clock: Virtual clock to advance
+    :param end: Time to stop the replay at
+    :param speed: Factor to run faster than real time or 0 for no limit
+    '''
+    start = clock()
+    real_start = time.time()
+    reset = next_reset(start)
+    # Heap of (wake-up time, camera index). Entries are removed lazily, only
+    # the time stored in `due` is valid for a camera.
+    due = [start] * len(cameras)
+    schedule = [(start, i) for i in range(len(cameras))]
+    while schedule:
+        when, i = heapq.heappop(schedule)
+        if due[i] != when:
+            continue
+        if when > end:
+            break
+
+        if reset <= when:
+            clock.set(reset)
+            for j, camera in enumerate(cameras):
+                camera.set_control('automatic')
+                due[j] = reset
+                heapq.heappush(schedule, (reset, j))
+            reset = next_reset(reset)
+            continue
+
+        if speed:
+            time.sleep(max(real_start + (when - start) / speed
+                           - time.time(), 0))
+        clock.set(when)
+
+        camera = cameras[i]
+        if camera.agent.calendar_initialized:
+            camera.update()
+        if command := camera.commands.get():
+            camera.execute(command)
+            camera.commands.done()
+
+        wakeup = max(camera.next_update(), when + 1)
+        transition = camera.agent.next_transition()
+        if transition is not None and when < transition < wakeup:
+            wakeup = transition
+        due[i] = wakeup
+        heapq.heappush(schedule, (wakeup, i))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Schedule replay')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Path to a configuration file')
+    parser.add_argument('snapshot', nargs='?',
+                        help='Calendar snapshot to replay (default: '
+                        'snapshot from the configuration)')
+    parser.add_argument('--speed', type=float, default=1000,
+                        help='Factor to run faster than real time or 0 to '
+                        'run as fast as possible (default: 1000)')
+    parser.add_argument('--loglevel', default='WARNING',
+                        help='Log level of the camera control '
+                        '(default: WARNING)')
+    args = parser.parse_args()
+
+    setup(files=[args.config])
+    logging.basicConfig(level=args.loglevel.upper())
+    snapshot_path = args.snapshot or config_t(str, 'calendar', 'snapshot')
+    if not snapshot_path:
+        sys.exit('No calendar snapshot to replay')
+
+    agents = []
+    cameras = []
+    simulated = []
+    for agent_id, agent_cameras in config_rt(dict, 'camera').items():
+        agent = Agent(agent_id)
+        agents.append(agent)
+        for camera in agent_cameras:
+            cam = Camera(agent, **camera)
+            sim = SimulatedCamera(cam.url, agent_id, cam.type.value)
+            adapter = SimulatedCameraAdapter(sim, cam.url)
+            # Skip looking up proxies in the environment for every request
+            cam.session.trust_env = False
+            cam.session.mount('http://', adapter)
+            cam.session.mount('https://', adapter)
+            cameras.append(cam)
+            simulated.append(sim)
+
+    # Read the time span from the snapshot file first. Loading the snapshot
+    # prunes past events, so the virtual clock needs to be set before.
+    try:
+        with open(snapshot_path, 'r') as f:
+            calendars = json.load(f)['agents']
+    except (OSError, ValueError, KeyError) as e:
+        sys.exit(f'Failed to read {snapshot_path}: {e}')
+    events = [event for agent in agents
+              for event in calendars.get(agent.agent_id, {}).get('events', [])]
+    if not events:
+        sys.exit(f'No events found in {snapshot_path}')
+    # Start early enough for cameras to be moved to their inactive preset
+    start = min(event_start for _, event_start, _ in events) - 3600
+    end = max(event_end for _, _, event_end in events) + 3600
+
+    clock = VirtualClock(start)
+    set_clock(clock)
+    CalendarSnapshot(snapshot_path, agents).load()
+
+    days = (end - start) / 86400
+    print(f'Replaying {len(events)} events of {len(agents)} agents for '
+          f'{len(cameras)} cameras over {days:.1f} days')
+    replay_start = time.time()
+    replay(cameras, clock, end, args.speed)
+    duration = time.time() - replay_start
+
+    print(f'Replayed in {duration:.1f} s '
+          f'({(end - start) / duration:,.0f} times real time)\n')
+    print(f'{"Camera":<48} {"Requests":>9} {"Commands":>9} '
+          f'{"Redundant":>9} {"Moves":>9}')
+    for sim in simulated:
+        print(f'{sim.name[:48]:<48} {sim.requests:9} {sim.commands:9} '
+              f'{sim.redundant:9} {sim.moves:9}')
+    print(f'{"Total":<48} {sum(s.requests for s in simulated):9} '
+          f'{sum(s.commands for s in simulated):9} '
+          f'{sum(s.redundant for s in simulated):9} '
+          f'{sum(s.moves for s in simulated):9}')
+
+
+if __name__ == '__main__':
+    main()
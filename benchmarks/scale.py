@@ -0,0 +1,153 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Scale benchmark for the camera control.
+
+Starts the camera control service against the local Opencast and camera
+simulator with a given number of agents and cameras. All events of all
+agents start at the same time. Reports the CPU time, memory and threads used
+by the service, the request rate handled by the simulator and how long it
+took until the cameras were moved after the events started.
+
+Run this from the repository root on Linux::
+
+    PYTHONPATH=. python benchmarks/scale.py [agents] [cameras per agent]
+'''
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from simulator import Simulator
+
+
+def free_port() -> int:
+    '''Returns a currently unused TCP port.
+    '''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_stats(pid: int) -> tuple[float, float, int]:
+    '''Returns CPU time in seconds, resident set size in MiB and number of
+    threads of a process.
+    '''
+    with open(f'/proc/{pid}/stat') as f:
+        # The command name may contain spaces, skip it
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    threads = int(fields[17])
+    rss = int(fields[21]) * resource.getpagesize() / 2**20
+    return cpu, rss, threads
+
+
+def percentile(values: list[float], p: float) -> float:
+    '''Returns the p-th percentile of the values.
+    '''
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scale benchmark')
+    parser.add_argument('agents', type=int, nargs='?', default=100,
+                        help='Number of agents (default: 100)')
+    parser.add_argument('cameras', type=int, nargs='?', default=2,
+                        help='Number of cameras per agent (default: 2)')
+    parser.add_argument('--engine', default='threading',
+                        choices=('threading', 'asyncio'),
+                        help='Control engine (default: threading)')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Seconds to run the benchmark (default: 60)')
+    parser.add_argument('--start-in', type=float, default=20,
+                        help='Seconds until the events start (default: 20)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Delay of camera responses in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Share of failing camera requests (0-1)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Request the calendars of all agents at once')
+    args = parser.parse_args()
+
+    simulator = Simulator(args.agents, args.cameras,
+                          start_in=args.start_in,
+                          length=args.duration,
+                          latency=args.latency,
+                          failure_rate=args.failure_rate)
+    url = simulator.start()
+    config = simulator.config(url, args.engine, free_port())
+    config['calendar']['bulk'] = args.bulk
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yml') as config_file:
+        json.dump(config, config_file)
+        config_file.flush()
+
+        print(f'Controlling {args.agents * args.cameras} cameras of '
+              f'{args.agents} agents with the {args.engine} engine')
+        process = subprocess.Popen(
+                (sys.executable, '-m', 'occameracontrol',
+                 '-c', config_file.name),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        start = time.time()
+        peak_rss = 0.0
+        peak_threads = 0
+        cpu = rss = 0.0
+        threads = 0
+        try:
+            while time.time() - start < args.duration:
+                time.sleep(1)
+                if process.poll() is not None:
+                    sys.exit('Camera control terminated unexpectedly')
+                cpu, rss, threads = process_stats(process.pid)
+                peak_rss = max(peak_rss, rss)
+                peak_threads = max(peak_threads, threads)
+        finally:
+            process.terminate()
+            process.wait()
+            simulator.stop()
+
+    duration = time.time() - start
+    requests = simulator.requests
+    latencies = simulator.move_latencies()
+    moves = len(latencies)
+    expected = args.agents * args.cameras * sum(
+            start <= time.time() for start in simulator.starts)
+
+    print(f'CPU time     {cpu:10.1f} s ({cpu / duration * 100:.1f} %)')
+    print(f'RSS          {rss:10.1f} MiB (peak {peak_rss:.1f} MiB)')
+    print(f'Threads      {threads:10} (peak {peak_threads})')
+    print(f'Requests     {requests["camera"] / duration:10.1f} camera/s, '
+          f'{requests["opencast"] / duration:.1f} Opencast/s, '
+          f'{requests["failed"]} failed')
+    if latencies:
+        print(f'Move latency {percentile(latencies, 50):10.3f} s median, '
+              f'{percentile(latencies, 95):.3f} s p95, '
+              f'{max(latencies):.3f} s max ({moves} of {expected} moves)')
+    else:
+        print(f'Move latency        n/a (0 of {expected} moves)')
+
+
+if __name__ == '__main__':
+    main()
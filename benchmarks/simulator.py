@@ -0,0 +1,363 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Local stand-in for Opencast and a set of PTZ cameras.
+
+A single HTTP server simulates the Opencast endpoints used by the camera
+control (`/capture-admin/agents/<agent>` and `/recordings/calendar.json`) as
+well as Panasonic (`/camera/<name>/cgi-bin/aw_ptz`) and Sony
+(`/camera/<name>/command/*.cgi`) cameras. Camera responses can be delayed
+and can fail randomly. The simulator records all requests and how long it
+took until cameras were moved to their active preset after an event started.
+
+Run this from the repository root to get a simulator and a matching
+configuration for manual tests::
+
+    PYTHONPATH=. python benchmarks/simulator.py [agents] [cameras per agent]
+'''
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class SimulatedCamera:
+    '''State of a simulated camera. The camera counts the commands it
+    received, how many of them were redundant since the camera was in the
+    requested state already and how often it actually moved.
+    '''
+
+    def __init__(self, name: str, agent_id: str, type: str,
+                 on_move: Optional[Callable] = None):
+        '''Create a SimulatedCamera instance.
+
+        :param name: Camera name used in the URL
+        :param agent_id: Capture agent the camera belongs to
+        :param type: Camera type (`panasonic` or `sony`)
+        :param on_move: Function called whenever a preset is recalled
+        '''
+        self.name = name
+        self.agent_id = agent_id
+        self.type = type
+        self.on_move = on_move
+        self.power = False
+        self.preset = 0
+        self.requests = 0
+        self.commands = 0
+        self.redundant = 0
+        self.moves = 0
+        # Latency of the first move to the active preset per event start
+        self.latencies: dict[float, float] = {}
+
+    def set_power(self, on: bool):
+        '''Turn the camera on or put it into standby mode.
+        '''
+        self.commands += 1
+        if self.power == on:
+            self.redundant += 1
+        self.power = on
+
+    def recall(self, preset: int):
+        '''Move the camera to a preset.
+        '''
+        self.commands += 1
+        if self.preset == preset:
+            self.redundant += 1
+        else:
+            self.moves += 1
+        self.preset = preset
+        if self.on_move:
+            self.on_move(self)
+
+    def handle(self, path: str, query: dict) -> str:
+        '''Handle a request to the camera and return the response body.
+        Raises a LookupError for unknown requests.
+
+        :param path: Path of the request relative to the camera URL
+        :param query: Parsed query parameters
+        '''
+        self.requests += 1
+        if self.type == 'panasonic':
+            return self.panasonic(query)
+        return self.sony(path, query)
+
+    def panasonic(self, query: dict) -> str:
+        '''Handle a Panasonic `aw_ptz` command.
+        '''
+        command = query.get('cmd', [''])[0]
+        if command in ('#On', '#Of'):
+            self.set_power(command == '#On')
+        elif command.startswith('#R'):
+            self.recall(int(command[2:]) + 1)
+        elif command == '#S':
+            return f's{self.preset - 1:02}'
+        elif command != '#O':
+            raise LookupError(command)
+        return 'p1' if self.power else 'p0'
+
+    def sony(self, path: str, query: dict) -> str:
+        '''Handle a Sony CGI command.
+        '''
+        if path == 'command/main.cgi':
+            self.set_power(query.get('System') == ['on'])
+        elif path == 'command/presetposition.cgi':
+            self.recall(int(query['PresetCall'][0].split(',')[0]))
+        elif query.get('inq') == ['system']:
+            return 'Power=' + ('on' if self.power else 'standby')
+        elif query.get('inq') == ['presetposition']:
+            return f'PresetCall={self.preset}'
+        else:
+            raise LookupError(path)
+        return 'OK'
+
+
+class Simulator:
+    '''Simulated Opencast and cameras. Every agent gets `events` events of
+    `length` seconds, the first one starting `start_in` seconds from now and
+    the following ones every `interval` seconds.
+    '''
+
+    def __init__(self, agents: int, cameras: int, start_in: float = 30,
+                 length: float = 60, interval: float = 120,
+                 events: int = 10, latency: float = 0.0,
+                 failure_rate: float = 0.0, preset_active: int = 1):
+        '''Create a Simulator instance.
+
+        :param agents: Number of capture agents
+        :param cameras: Number of cameras per agent
+        :param start_in: Seconds until the first event starts
+        :param length: Length of each event in seconds
+        :param interval: Seconds between the starts of events
+        :param events: Number of events per agent
+        :param latency: Seconds each camera request is delayed
+        :param failure_rate: Share of camera requests failing
+        :param preset_active: Preset cameras are moved to during events
+        '''
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.preset_active = preset_active
+        # Opencast dates have a resolution of seconds
+        start = int(time.time() + start_in)
+        self.starts = [start + i * interval for i in range(events)]
+        self.length = length
+        self.agents = [f'agent-{i}' for i in range(agents)]
+        self.cameras = {}
+        for agent_id in self.agents:
+            for j in range(cameras):
+                name = f'{agent_id}-camera-{j}'
+                type = ('panasonic', 'sony')[j % 2]
+                self.cameras[name] = SimulatedCamera(name, agent_id, type,
+                                                     self.record_move)
+        self.calendars = {agent_id: self.calendar(agent_id)
+                          for agent_id in self.agents}
+        self.calendars[None] = self.calendar(None)
+        self.requests = {'opencast': 0, 'camera': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def calendar(self, agent_id: Optional[str]) -> tuple[bytes, str]:
+        '''Returns the calendar of an agent or of all agents as JSON and its
+        ETag.
+        '''
+        events = []
+        for agent in self.agents if agent_id is None else [agent_id]:
+            for i, start in enumerate(self.starts):
+                events.append({'data': {
+                    'startDate': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                               time.gmtime(start)),
+                    'endDate': time.strftime(
+                        '%Y-%m-%dT%H:%M:%SZ',
+                        time.gmtime(start + self.length)),
+                    'agentConfig': {'event.title': f'Event {i}',
+                                    'event.location': agent}}})
+        data = json.dumps(events).encode()
+        return data, '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+
+    def config(self, url: str, engine: str = 'threading',
+               port: int = 8080) -> dict:
+        '''Returns a camera control configuration using this simulator.
+
+        :param url: Base URL of the simulator
+        :param engine: Control engine to use
+        :param port: Port of the camera control server
+        '''
+        cameras: dict[str, list[dict]] = {agent: [] for agent in self.agents}
+        for camera in self.cameras.values():
+            cameras[camera.agent_id].append({
+                'url': f'{url}/camera/{camera.name}',
+                'type': camera.type,
+                'user': 'admin',
+                'password': 'admin',
+                'preset_active': self.preset_active})
+        return {'opencast': {'server': url,
+                             'username': 'admin',
+                             'password': 'opencast'},
+                'basic_auth': {'username': 'admin', 'password': 'admin'},
+                'server': {'port': port},
+                'calendar': {'update_frequency': 120},
+                'reset_time': '03:00',
+                'engine': engine,
+                'camera': cameras,
+                'loglevel': 'warning'}
+
+    def record_move(self, camera: SimulatedCamera):
+        '''Record the latency of moving a camera to its active preset after
+        the start of the current or next event.
+        '''
+        if camera.preset != self.preset_active:
+            return
+        now = time.time()
+        for start in self.starts:
+            if now < start + self.length:
+                camera.latencies.setdefault(start, now - start)
+                return
+
+    def move_latencies(self) -> list[float]:
+        '''Returns the latencies of all camera moves after events started.
+        '''
+        return [latency for camera in self.cameras.values()
+                for start, latency in camera.latencies.items()
+                if start <= time.time()]
+
+    def handler(self):
+        '''Returns a request handler class serving this simulator.
+        '''
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status: int, body: bytes = b'',
+                        headers: Optional[dict[str, str]] = None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith('/camera/'):
+                    self.camera(url.path, query)
+                else:
+                    self.opencast(url.path, query)
+
+            def opencast(self, path: str, query: dict):
+                with simulator._lock:
+                    simulator.requests['opencast'] += 1
+                if path.startswith('/capture-admin/agents/'):
+                    agent_id = path.rsplit('/', 1)[-1].removesuffix('.json')
+                    if agent_id not in simulator.calendars:
+                        return self.respond(404)
+                    return self.respond(200, b'{}')
+                if path == '/recordings/calendar.json':
+                    agent_id = query.get('agentid', [None])[0]
+                    if agent_id not in simulator.calendars:
+                        return self.respond(404)
+                    data, etag = simulator.calendars[agent_id]
+                    if self.headers.get('If-None-Match') == etag:
+                        return self.respond(304, headers={'ETag': etag})
+                    return self.respond(200, data, {
+                        'ETag': etag,
+                        'Content-Type': 'application/json'})
+                self.respond(404)
+
+            def camera(self, path: str, query: dict):
+                _, _, name, command = path.split('/', 3)
+                camera = simulator.cameras.get(name)
+                if not camera:
+                    return self.respond(404)
+                if camera.type == 'sony' and not self.headers.get(
+                        'Authorization', '').startswith('Digest'):
+                    return self.respond(401, headers={
+                        'WWW-Authenticate':
+                        'Digest realm="camera", nonce="simulator", '
+                        'qop="auth"'})
+                if simulator.latency:
+                    time.sleep(simulator.latency)
+                with simulator._lock:
+                    simulator.requests['camera'] += 1
+                    if random.random() < simulator.failure_rate:
+                        simulator.requests['failed'] += 1
+                        return self.respond(503)
+                    try:
+                        body = camera.handle(command, query)
+                    except LookupError:
+                        return self.respond(404)
+                self.respond(200, body.encode())
+
+        return Handler
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        '''Start the simulator in a background thread and return its URL.
+        '''
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def stop(self):
+        '''Stop the simulator.
+        '''
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Opencast and camera simulator')
+    parser.add_argument('agents', type=int, nargs='?', default=10,
+                        help='Number of agents (default: 10)')
+    parser.add_argument('cameras', type=int, nargs='?', default=1,
+                        help='Number of cameras per agent (default: 1)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port to listen on (default: 8000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Delay of camera responses in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Share of failing camera requests (0-1)')
+    args = parser.parse_args()
+
+    simulator = Simulator(args.agents, args.cameras, latency=args.latency,
+                          failure_rate=args.failure_rate)
+    url = simulator.start(port=args.port)
+    print(json.dumps(simulator.config(url), indent=2))
+    try:
+        while True:
+            time.sleep(10)
+            print(f'Requests: {simulator.requests}')
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
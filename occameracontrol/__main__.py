@@ -16,16 +16,28 @@
 
 import argparse
 import datetime
+import heapq
 import logging
 import sys
 import time
 
+from concurrent.futures import FIRST_COMPLETED, Future, \
+        ThreadPoolExecutor, wait
 from confygure import setup, config_t, config_rt
-from threading import Thread
+from threading import Event, Thread, Timer
+from typing import Callable, Optional
 
-from occameracontrol.agent import Agent
+from occameracontrol import clock
+from occameracontrol.agent import Agent, opencast_breaker
+from occameracontrol.bulk_calendar import BulkCalendar
 from occameracontrol.camera import Camera
-from occameracontrol.metrics import RequestErrorHandler
+from occameracontrol.collector import register_state_collector
+from occameracontrol.dispatcher import Dispatcher
+from occameracontrol.metrics import RequestErrorHandler, register_loop_lag
+from occameracontrol.scheduler import Scheduler
+from occameracontrol.sender import CommandSender
+from occameracontrol.snapshot import CalendarSnapshot
+from occameracontrol.startup import Startup
 
 from occameracontrol.camera_control_server import start_camera_control_server
 
@@ -33,57 +45,172 @@ from occameracontrol.camera_control_server import start_camera_control_server
 logger = logging.getLogger(__name__)
 
 
+def run_scheduled(task: Callable[[int], Optional[float]], count: int,
+                  workers: int):
+    '''Run a task for the indices `0 … count-1` on a bounded pool of workers.
+    The task returns the number of seconds after which it should be run again
+    for the same index or `None` if it does not need to be run again. Every
+    index follows its own schedule, so that a slow task does not delay the
+    others. This returns once no task needs to be run again.
+
+    :param task: Task to run for each index
+    :param count: Number of indices
+    :param workers: Maximum number of tasks to run in parallel
+    '''
+    def run(i: int) -> tuple[int, Optional[float]]:
+        return i, task(i)
+
+    # Heap of (time of the next run, index)
+    schedule = [(0.0, i) for i in range(count)]
+    running: set[Future] = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while schedule and schedule[0][0] <= time.time():
+                _, i = heapq.heappop(schedule)
+                running.add(executor.submit(run, i))
+
+            if not running:
+                if not schedule:
+                    return
+                time.sleep(max(schedule[0][0] - time.time(), 0))
+                continue
+
+            timeout = schedule[0][0] - time.time() if schedule else None
+
+            done, running = wait(running, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                i, delay = future.result()
+                if delay is not None:
+                    heapq.heappush(schedule, (time.time() + delay, i))
+
+
 def update_agents(agents: list[Agent]):
     '''Control loop for updating the capture agent calendars on a regular basis
+    The calendars are updated concurrently by a bounded pool of workers and
+    every agent follows its own schedule, so that a slow or unreachable agent
+    does not delay the updates of other agents.
     '''
-    update_frequency = config_t(int, 'calendar', 'update_frequency') or 120
+    workers = config_t(int, 'calendar', 'workers') or 8
+    breaker = opencast_breaker()
     error_handlers = {
         agent.agent_id: RequestErrorHandler(
                 agent.agent_id,
-                f'Failed to update calendar of agent {agent.agent_id}')
+                f'Failed to update calendar of agent {agent.agent_id}',
+                breaker)
         for agent in agents}
 
+    def update_calendar(i: int) -> float:
+        # Skip updates while Opencast is unreachable
+        if not breaker.allow():
+            return agents[i].calendar_update_delay()
+        with error_handlers[agents[i].agent_id]:
+            agents[i].update_calendar()
+        return agents[i].calendar_update_delay()
+
+    # Continuously update agent calendars
+    run_scheduled(update_calendar, len(agents), workers)
+
+
+def verify_agents(agents: list[Agent], startup: Startup,
+                  ready: Callable[[Agent], None]):
+    '''Verify all agents concurrently with a bounded pool of workers and call
+    `ready` for each agent as soon as it is verified. Agents which cannot be
+    verified are retried with an increasing delay.
+    '''
+    workers = config_t(int, 'calendar', 'workers') or 8
+    attempts = [0] * len(agents)
+    error_handlers = {
+        agent.agent_id: RequestErrorHandler(
+                agent.agent_id,
+                f'Failed to verify agent {agent.agent_id}')
+        for agent in agents}
+
+    def verify_agent(i: int) -> Optional[float]:
+        agent = agents[i]
+        start = time.time()
+        verified = False
+        with error_handlers[agent.agent_id]:
+            agent.verify_agent()
+            verified = True
+        duration = time.time() - start
+        if not verified:
+            attempts[i] += 1
+            return startup.failed(agent, duration, attempts[i])
+        startup.verified(agent, duration)
+        ready(agent)
+        return None
+
+    run_scheduled(verify_agent, len(agents), workers)
+
+
+def update_calendars(calendar: BulkCalendar):
+    '''Control loop for updating the calendars of all capture agents with a
+    single request on a regular basis
+    '''
+    update_frequency = config_t(int, 'calendar', 'update_frequency') or 120
+    breaker = opencast_breaker()
+    error_handler = RequestErrorHandler(
+            'calendar',
+            'Failed to update calendar of all agents',
+            breaker)
+
     # Continuously update agent calendars
     while True:
-        for agent in agents:
-            with error_handlers[agent.agent_id]:
-                agent.update_calendar()
-        time.sleep(update_frequency)
+        if breaker.allow():
+            with error_handler:
+                calendar.update()
+        time.sleep(max(update_frequency, breaker.retry_in()))
+
+
+def reset_control(cameras: list[Camera], reset_time: datetime.datetime):
+    """Reset all cameras to automatic control once a day.
+    param cameras: Cameras to reset
+    param reset_time: datetime of the first reset
+    """
+    while True:
+        time.sleep(max(reset_time.timestamp() - clock.now(), 0))
+        logger.info('Reset all cameras to \'automatic\'')
+        for camera in cameras:
+            camera.set_control('automatic')
+        reset_time = reset_time + datetime.timedelta(days=1)
+        logger.info('Next reset time is set to %s', reset_time)
 
 
-def control_camera(camera: Camera, reset_time: datetime.datetime):
+def control_camera(camera: Camera):
     """Control loop to trigger updating the camera position based on currently
-    active events.
+    active events. The loop is woken up right away on state transitions of
+    the agent and on control status changes.
     param camera: Camera object to control
-    param reset_time: datetime to reset control to automatic (default: 03:00)
     """
-    if reset_time is None:
-        reset_time = datetime.datetime.combine(
-            date=datetime.date.today(),
-            time=datetime.time(3, 00, 00)
-        )
     error_handler = RequestErrorHandler(
             camera.url,
             f'Failed to communicate with camera {camera}')
+    wakeup = Event()
+    camera.subscribe(wakeup.set)
+    camera.agent.subscribe(wakeup.set)
     while True:
+        wakeup.clear()
+        retry = True
         with error_handler:
-            if reset_time < datetime.datetime.now():
-                logger.info(f'current time is {datetime.datetime.now()}, '
-                            f'the reset time is {reset_time}')
-                logger.info(f'Reset {camera} to \'automatic\'')
-                camera.control = "automatic"
-                camera.position = -1
-                reset_time = reset_time + datetime.timedelta(days=1)
-                logger.info(f'Next reset time is set to {reset_time}')
-            if camera.control == "automatic":
-                camera.update_position()
+            if not camera.agent.calendar_initialized:
+                # We get notified once the calendar is available
+                logger.debug('[%s] Calendar not yet initialized…',
+                             camera.agent.agent_id)
             else:
-                camera.activate_camera()
-                camera.check_calendar()
-        time.sleep(1)
+                camera.update()
+            retry = False
+
+        # Sleep until the next re-send is due, an error needs to be retried
+        # or until we get notified about a state change
+        timeout = camera.wakeup_timeout(retry)
+        scheduled = time.time() + timeout
+        if not wakeup.wait(timeout):
+            register_loop_lag('camera', time.time() - scheduled)
 
 
 def main():
+    started = time.time()
     parser = argparse.ArgumentParser(description='Opencast Camera Control')
     parser.add_argument(
         '-c', '--config',
@@ -104,6 +231,11 @@ def main():
         print('Could not find a configuration file in', config_files)
         sys.exit(1)
 
+    engine = config_t(str, 'engine') or 'threading'
+    if engine not in ('threading', 'asyncio'):
+        print('Invalid control engine', engine)
+        sys.exit(1)
+
     cameras = []
     agents = []
     reset_time = datetime.datetime.combine(
@@ -113,7 +245,6 @@ def main():
     logger.info('reset time is set to %s', reset_time)
     for agent_id, agent_cameras in config_rt(dict, 'camera').items():
         agent = Agent(agent_id)
-        agent.verify_agent()
         agents.append(agent)
         logger.debug('Configuring agent %s', agent_id)
         for camera in agent_cameras:
@@ -121,18 +252,92 @@ def main():
             logger.debug('Configuring camera: %s', cam)
             cameras.append(cam)
 
+    register_state_collector(agents, cameras)
+
     threads = []
-    agent_update = Thread(target=update_agents, args=(agents,))
-    threads.append(agent_update)
-    agent_update.start()
-
-    for camera in cameras:
-        logger.info('Starting camera control for %s with control status %s',
-                    camera, getattr(camera, 'control'))
-        control_thread = Thread(target=control_camera,
-                                args=(camera, reset_time))
-        threads.append(control_thread)
-        control_thread.start()
+
+    # Load cached calendars so that cameras can be controlled right away
+    if snapshot_path := config_t(str, 'calendar', 'snapshot'):
+        snapshot = CalendarSnapshot(snapshot_path, agents)
+        snapshot.load()
+        snapshot_thread = Thread(target=snapshot.run)
+        threads.append(snapshot_thread)
+        snapshot_thread.start()
+
+    # Agents are verified in the background. Startup is finished once all
+    # agents are verified or after the startup timeout.
+    startup = Startup(agents, started)
+    startup_timer = Timer(startup.timeout(), startup.finish)
+    startup_timer.daemon = True
+    startup_timer.start()
+
+    scheduler = Scheduler()
+    for agent in agents:
+        scheduler.add(agent)
+    scheduler_thread = Thread(target=scheduler.run)
+    threads.append(scheduler_thread)
+    scheduler_thread.start()
+
+    reset_thread = Thread(target=reset_control, args=(cameras, reset_time))
+    threads.append(reset_thread)
+    reset_thread.start()
+
+    dispatcher = Dispatcher()
+    dispatcher_thread = Thread(target=dispatcher.run)
+    threads.append(dispatcher_thread)
+    dispatcher_thread.start()
+
+    if engine == 'asyncio':
+        # Only import the asynchronous engine if requested since it requires
+        # optional dependencies
+        from occameracontrol import async_engine
+        logger.info('Starting asynchronous control engine')
+        engine_thread = Thread(target=async_engine.start,
+                               args=(agents, cameras, startup, dispatcher))
+        threads.append(engine_thread)
+        engine_thread.start()
+    else:
+        if config_t(bool, 'calendar', 'bulk'):
+            agent_update = Thread(target=update_calendars,
+                                  args=(BulkCalendar(agents),))
+        else:
+            agent_update = Thread(target=update_agents, args=(agents,))
+        threads.append(agent_update)
+        agent_update.start()
+
+        # Commands of all cameras are sent by a shared pool of workers
+        sender = CommandSender(dispatcher)
+        sender_thread = Thread(target=sender.run)
+        threads.append(sender_thread)
+        sender_thread.start()
+
+        def start_cameras(agent: Agent):
+            for camera in cameras:
+                if camera.agent is not agent:
+                    continue
+                logger.info(
+                        'Starting camera control for %s with control status '
+                        '%s', camera, getattr(camera, 'control'))
+                sender.add(camera)
+                thread = Thread(target=control_camera, args=(camera,))
+                threads.append(thread)
+                thread.start()
+
+        # Control the cameras of agents with a restored calendar right away,
+        # even if Opencast is unavailable. They are verified in parallel.
+        restored = {agent.agent_id for agent in agents
+                    if agent.calendar_initialized}
+        for agent in agents:
+            if agent.agent_id in restored:
+                start_cameras(agent)
+
+        def agent_verified(agent: Agent):
+            if agent.agent_id not in restored:
+                start_cameras(agent)
+
+        verification = Thread(target=verify_agents,
+                              args=(agents, startup, agent_verified))
+        verification.start()
 
     # Start camera control server
     auth = (config_rt(str, 'basic_auth', 'username'),
@@ -14,22 +14,121 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bisect
+import datetime
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import random
+import re
 import requests
+import sys
+import threading
 import time
 
+from array import array
+from calendar import timegm
 from confygure import config_t, config_rt
 from dateutil.parser import parse
+from typing import Callable, Iterable, Iterator, Optional
 
-from occameracontrol.metrics import register_calendar_update
+from occameracontrol import clock
+from occameracontrol.metrics import register_calendar_update, \
+        register_calendar_age, register_calendar_parse, \
+        calendar_fetch_metric, CircuitBreaker, ConnectionMetricsAdapter
 
 
 logger = logging.getLogger(__name__)
 
+# Timestamp format used by Opencast, e.g. `2024-02-08T14:00:00Z`
+iso_timestamp = re.compile(
+        r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?'
+        r'(?:Z|([+-])(\d\d):?(\d\d))$')
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_date(value: str) -> float:
+    '''Parse a date from an Opencast calendar and return it as Unix
+    timestamp. The ISO 8601 format Opencast uses is handled directly while
+    all other formats fall back to the much slower `dateutil`.
+    Results are cached, so dates of unchanged events are never parsed again.
+    '''
+    match = iso_timestamp.match(value)
+    if not match:
+        return parse(value, dayfirst=True).timestamp()
+    year, month, day, hour, minute, second, fraction, sign, tz_hour, \
+        tz_minute = match.groups()
+    timestamp = timegm((int(year), int(month), int(day),
+                        int(hour), int(minute), int(second)))
+    if fraction:
+        timestamp += float(fraction)
+    if sign:
+        offset = int(tz_hour) * 3600 + int(tz_minute) * 60
+        timestamp += -offset if sign == '+' else offset
+    return float(timestamp)
+
+
+def opencast_server() -> str:
+    '''Returns the configured Opencast server without trailing slash.
+    '''
+    return config_rt(str, 'opencast', 'server').rstrip('/')
+
+
+def opencast_auth() -> tuple[str, str]:
+    '''Returns the credentials for authenticating against Opencast.
+    '''
+    username = config_rt(str, 'opencast', 'username')
+    password = config_rt(str, 'opencast', 'password')
+    return (username, password)
+
+
+def calendar_cutoff() -> int:
+    '''Returns the calendar cutoff time in milliseconds.
+    '''
+    week_in_seconds = 7 * 24 * 60 * 60
+    cutoff_seconds = config_t(int, 'calendar', 'cutoff') or week_in_seconds
+    return (int(clock.now()) + cutoff_seconds) * 1000
+
+
+def conditional_headers(etag: Optional[str],
+                        last_modified: Optional[str]) -> dict[str, str]:
+    '''Returns the headers for a conditional request based on the ETag and
+    Last-Modified headers of a previous response.
+    '''
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+@functools.lru_cache(maxsize=None)
+def opencast_session() -> requests.Session:
+    '''Returns the HTTP session shared by all requests to Opencast. This
+    allows connections to be kept alive and re-used.
+    '''
+    session = requests.Session()
+    session.auth = opencast_auth()
+    adapter = ConnectionMetricsAdapter(opencast_server())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def opencast_breaker() -> CircuitBreaker:
+    '''Returns the circuit breaker shared by all requests to Opencast.
+    '''
+    return CircuitBreaker(opencast_server())
+
 
 class Event:
     '''An scheduled Opencast event from an agent's calendar.
     '''
+    __slots__ = ('title', 'start', 'end')
     title: str
     start: float
     end: float
@@ -39,15 +138,16 @@ class Event:
         self.start = start
         self.end = end
 
-    def active(self) -> bool:
+    def active(self, lead: float = 0.0) -> bool:
         '''If the event is active based on the current time
+        :param lead: Seconds before the start to consider the event active
         '''
-        return self.start <= time.time() < self.end
+        return self.start - lead <= clock.now() < self.end
 
     def future(self) -> bool:
         '''If the event is in the future based on the current time.
         '''
-        return time.time() < self.start < self.end
+        return clock.now() < self.start < self.end
 
     def __str__(self):
         '''A string representation of the event
@@ -55,22 +155,169 @@ class Event:
         return f'{self.title} (start: {self.start:.3f}, end: {self.end:.3f})'
 
 
+class EventStore:
+    '''Sorted events of a capture agent supporting lookups of the current or
+    next event in O(log n), independent of the size of the calendar.
+
+    Events are stored in columns of titles and arrays of start and end times
+    instead of event objects to keep the memory footprint of large calendars
+    small. Event objects are only created when they are looked up.
+
+    Expired events are pruned incrementally while looking up events and the
+    events are replaced atomically, so lookups are thread-safe while the
+    calendar is updated.
+    '''
+
+    def __init__(self, events: Iterable[Event] = ()):
+        # Columns of titles, starts and ends of the events sorted by start and
+        # the maximum end of all events up to the same index. The latter is
+        # monotonic even for overlapping events and can be used for finding
+        # the first event not yet ended.
+        self._data: tuple[list[str], array, array, array] = \
+            ([], array('d'), array('d'), array('d'))
+        self._lock = threading.Lock()
+        self.replace(events)
+
+    def replace(self, events: Iterable[Event]):
+        '''Atomically replace all events in the store.
+        '''
+        events = sorted(events, key=lambda e: e.start)
+        titles = [e.title for e in events]
+        starts = array('d', (e.start for e in events))
+        ends = array('d', (e.end for e in events))
+        max_ends = array('d', itertools.accumulate(ends, max))
+        with self._lock:
+            self._data = (titles, starts, ends, max_ends)
+
+    def _prune(self, now: float) -> tuple[list[str], array, array, array]:
+        '''Remove all events which ended before `now` and return the
+        remaining columns.
+        '''
+        data = self._data
+        titles, starts, ends, max_ends = data
+        index = bisect.bisect_left(max_ends, now)
+        if index > 0:
+            titles, starts, ends, max_ends = (titles[index:], starts[index:],
+                                              ends[index:], max_ends[index:])
+            with self._lock:
+                # Do not prune if events have been replaced in the meantime
+                if self._data is data:
+                    self._data = (titles, starts, ends, max_ends)
+        return titles, starts, ends, max_ends
+
+    def active(self, now: float) -> list[Event]:
+        '''Return all events which have not ended before `now`.
+        '''
+        titles, starts, ends, _ = self._prune(now)
+        return [Event(*event) for event in zip(titles, starts, ends)
+                if event[2] >= now]
+
+    def next_event(self, now: float) -> Optional[Event]:
+        '''Return the first event which has not ended before `now`.
+        '''
+        titles, starts, ends, _ = self._prune(now)
+        return Event(titles[0], starts[0], ends[0]) if titles else None
+
+    def next_transition(self, now: float) -> Optional[float]:
+        '''Return the next point in time after `now` at which an event starts
+        or ends.
+        '''
+        _, starts, ends, max_ends = self._prune(now)
+        index = bisect.bisect_right(max_ends, now)
+        if index >= len(starts):
+            return None
+        return starts[index] if starts[index] > now else ends[index]
+
+    def __len__(self) -> int:
+        return len(self._data[0])
+
+    def __iter__(self) -> Iterator[Event]:
+        titles, starts, ends, _ = self._data
+        return (Event(*event) for event in zip(titles, starts, ends))
+
+
 class Agent:
     '''A capture agent with it's name and calendar
     '''
     agent_id: str
-    events: list[Event] = []
+    events: EventStore
     calendar_initialized: bool = False
+    calendar_hash: Optional[bytes] = None
+    calendar_updated: float = 0.0
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    listeners: list[Callable[[], None]]
+    # Current or next event and the next state transition, evaluated once
+    # per state transition and shared by all cameras of this agent
+    state: tuple[Event, Optional[float]]
+    state_valid_until: float = 0.0
 
     def __init__(self, agent_id: str):
         self.agent_id = agent_id
+        self.events = EventStore()
+        self.listeners = []
+        self.state = (Event('', 0, 0), None)
+        self._state_lock = threading.Lock()
+        self.fetch_duration = calendar_fetch_metric(agent_id)
+        register_calendar_age(agent_id, self.calendar_age)
+
+    def subscribe(self, callback: Callable[[], None]):
+        '''Register a callback which is called whenever the state of this
+        agent may have changed. This happens when the calendar is updated or
+        when an event starts or ends.
+        '''
+        self.listeners.append(callback)
+
+    def notify(self):
+        '''Evaluate the state of this agent and notify all subscribers about
+        a possible state change.
+        '''
+        self.evaluate()
+        for callback in self.listeners:
+            callback()
+
+    def evaluate(self) -> tuple[Event, Optional[float]]:
+        '''Evaluate the current or next event and the time of the next state
+        transition of this agent. The result is valid until that transition
+        or until the calendar changes.
+        '''
+        with self._state_lock:
+            now = clock.now()
+            event = self.events.next_event(now) or Event('', 0, 0)
+            transition = self.events.next_transition(now)
+            self.state = (event, transition)
+            self.state_valid_until = transition or float('inf')
+
+        if self.calendar_initialized:
+            self.log_state(event, now)
+        return event, transition
+
+    def log_state(self, event: Event, now: float):
+        '''Log the current or next event of this agent.
+        '''
+        if event.future():
+            logger.info('[%s] Next event `%s` starts in %s',
+                        self.agent_id, event.title[:40],
+                        datetime.timedelta(seconds=int(event.start - now)))
+        elif event.active():
+            logger.info('[%s] Active event `%s` ends in %s',
+                        self.agent_id, event.title[:40],
+                        datetime.timedelta(seconds=int(event.end - now)))
+        else:
+            logger.info('[%s] No planned events', self.agent_id)
+
+    def current_state(self) -> tuple[Event, Optional[float]]:
+        '''Returns the evaluated state of this agent, re-evaluating it only if
+        a state transition has happened since the last evaluation.
+        '''
+        if clock.now() >= self.state_valid_until:
+            return self.evaluate()
+        return self.state
 
     def cutoff(self) -> int:
         '''Returns the calendar cutoff time in milliseconds.
         '''
-        week_in_seconds = 7 * 24 * 60 * 60
-        cutoff_seconds = config_t(int, 'calendar', 'cutoff') or week_in_seconds
-        return (int(time.time()) + cutoff_seconds) * 1000
+        return calendar_cutoff()
 
     def parse_calendar(self, cal) -> list[Event]:
         '''Take the calendar data from Opencast and return a list of events.
@@ -78,9 +325,10 @@ class Agent:
         events = []
         for event in cal:
             data = event['data']
-            title = data['agentConfig']['event.title']
-            start = parse(data['startDate'], dayfirst=True).timestamp()
-            end = parse(data['endDate'], dayfirst=True).timestamp()
+            # Titles of recurring events are identical, store them only once
+            title = sys.intern(data['agentConfig']['event.title'])
+            start = parse_date(data['startDate'])
+            end = parse_date(data['endDate'])
             event = Event(title, start, end)
 
             logger.debug('Got event %s', event)
@@ -89,56 +337,147 @@ class Agent:
         # Make sure events are sorted
         return sorted(events, key=lambda e: e.start, reverse=False)
 
+    def calendar_age(self) -> float:
+        '''Returns the number of seconds since the calendar was last
+        successfully updated.
+        '''
+        return clock.now() - self.calendar_updated
+
+    def calendar_update_delay(self) -> float:
+        '''Returns the number of seconds until the next calendar update of
+        this agent. The configured update frequency is jittered to prevent
+        the updates of all agents from hitting Opencast at the same time.
+        '''
+        update_frequency = config_t(int, 'calendar', 'update_frequency') or 120
+        # Jitter only spreads the load, no cryptographic randomness needed
+        return update_frequency * random.uniform(0.9, 1.1)  # nosec B311
+
+    def calendar_params(self) -> dict:
+        '''Returns the query parameters for requesting the calendar of this
+        agent from Opencast.
+        '''
+        return {'agentid': self.agent_id, 'cutoff': self.cutoff()}
+
+    def calendar_headers(self) -> dict[str, str]:
+        '''Returns the headers for conditionally requesting the calendar of
+        this agent from Opencast, based on the last calendar received.
+        '''
+        return conditional_headers(self.etag, self.last_modified)
+
     def update_calendar(self):
         '''Get a calendar update fro Opencast
         '''
-        server = config_rt(str, 'opencast', 'server').rstrip('/')
-        username = config_rt(str, 'opencast', 'username')
-        password = config_rt(str, 'opencast', 'password')
-        auth = (username, password)
-        url = f'{server}/recordings/calendar.json'
-        params = {'agentid': self.agent_id, 'cutoff': self.cutoff()}
+        url = f'{opencast_server()}/recordings/calendar.json'
+        params = self.calendar_params()
+        headers = self.calendar_headers()
 
         logger.info('Updating calendar for agent `%s`', self.agent_id)
 
-        response = requests.get(url, auth=auth, params=params, timeout=5)
+        with self.fetch_duration.time():
+            response = opencast_session().get(url, params=params,
+                                              headers=headers, timeout=5)
         response.raise_for_status()
 
-        calendar = response.json()
+        if response.status_code == 304:
+            self.calendar_not_modified()
+            return
+        self.set_calendar(response.content,
+                          response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'))
+
+    def calendar_not_modified(self):
+        '''Record a calendar update which did not change the calendar.
+        '''
+        logger.debug('Calendar of agent `%s` did not change', self.agent_id)
+        self.calendar_updated = clock.now()
+        register_calendar_update(self.agent_id, applied=False)
+
+    def set_calendar(self, data: bytes, etag: Optional[str] = None,
+                     last_modified: Optional[str] = None):
+        '''Replace the cached events with those from the calendar data
+        received from Opencast. If the data did not change since the last
+        update, parsing the calendar is skipped.
+
+        :param data: Raw JSON calendar data
+        :param etag: ETag header of the calendar response
+        :param last_modified: Last-Modified header of the calendar response
+        '''
+        self.etag = etag
+        self.last_modified = last_modified
+
+        calendar_hash = hashlib.sha256(data).digest()
+        if calendar_hash == self.calendar_hash:
+            self.calendar_not_modified()
+            return
+        self.set_events(json.loads(data), calendar_hash)
+
+    def set_events(self, calendar: list, calendar_hash: bytes):
+        '''Replace the cached events with those from the calendar data and
+        notify all subscribers.
+
+        :param calendar: Parsed JSON calendar data
+        :param calendar_hash: Hash identifying the raw calendar data
+        '''
         logger.debug('Calendar data: %s', calendar)
 
-        self.events = self.parse_calendar(calendar)
-        register_calendar_update(self.agent_id)
+        start = time.time()
+        events = self.parse_calendar(calendar)
+        register_calendar_parse(time.time() - start)
+        self.events.replace(events)
+        self.calendar_hash = calendar_hash
+        self.calendar_updated = clock.now()
+        register_calendar_update(self.agent_id, applied=True)
+        self.calendar_initialized = True
+        self.notify()
+
+    def restore_events(self, events: list[Event], updated: float):
+        '''Restore previously cached events, e.g. from a calendar snapshot,
+        until the calendar is updated from Opencast. The calendar hash is left
+        unset so that the next update from Opencast is always applied.
+
+        :param events: List of events
+        :param updated: Time the events were received from Opencast
+        '''
+        logger.info('Restored %i cached events for agent `%s`',
+                    len(events), self.agent_id)
+        self.events.replace(events)
+        self.calendar_updated = updated
         self.calendar_initialized = True
+        self.notify()
 
-    def active_events(self):
+    def active_events(self) -> list[Event]:
         '''Return a list of active events
         '''
-        # Remove old events from cached events
-        now = time.time()
-        return [e for e in self.events if e.end >= now]
+        return self.events.active(clock.now())
 
     def next_event(self) -> Event:
         '''Return the next scheduled event.
         If no future events are scheduled for this agent, and empty event with
         start and end set to 0 will be returned.
         '''
-        events = self.active_events()
-        if not events:
-            return Event('', 0, 0)
-        return events[0]
+        event, _ = self.current_state()
+        return event
+
+    def next_transition(self) -> Optional[float]:
+        '''Return the point in time at which the state of this agent changes
+        next, i.e. the end of the currently active event or the start of the
+        next scheduled event. If no events are scheduled, `None` is returned.
+        '''
+        _, transition = self.current_state()
+        return transition
+
+    def verification_url(self) -> str:
+        '''Returns the URL for verifying that this agent exists in Opencast.
+        '''
+        return f'{opencast_server()}/capture-admin/agents/{self.agent_id}.json'
 
     def verify_agent(self):
         '''Verify that an agent exists when it is created
         '''
-        server = config_rt(str, 'opencast', 'server').rstrip('/')
-        username = config_rt(str, 'opencast', 'username')
-        password = config_rt(str, 'opencast', 'password')
-        auth = (username, password)
-        url = f'{server}/capture-admin/agents/{self.agent_id}.json'
+        url = self.verification_url()
         logger.info('Verification of agent `%s`', self.agent_id)
 
-        response = requests.get(url, auth=auth, timeout=5)
+        response = opencast_session().get(url, timeout=5)
         try:
             response.raise_for_status()
         except Exception:
@@ -0,0 +1,417 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Asynchronous control engine driving all agents and cameras from a single
+event loop instead of using one thread per camera.
+
+This engine requires the optional dependency `aiohttp`.
+'''
+
+import aiohttp
+import asyncio
+import logging
+import time
+
+from confygure import config_t
+
+from occameracontrol.agent import Agent, opencast_auth, opencast_breaker, \
+        opencast_server
+from occameracontrol.bulk_calendar import BulkCalendar
+from occameracontrol.camera import Camera, CameraCommand, CameraType
+from occameracontrol.command_queue import Command
+from occameracontrol.dispatcher import Dispatcher
+from occameracontrol.metrics import RequestErrorHandler, \
+        register_http_request, register_loop_lag
+from occameracontrol.startup import Startup
+
+
+logger = logging.getLogger(__name__)
+
+timeout = aiohttp.ClientTimeout(total=5)
+# Large responses are streamed and may take longer than the default timeout
+stream_timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=5)
+
+
+class AsyncRequestErrorHandler(RequestErrorHandler):
+    '''Request error handler additionally treating errors of the asynchronous
+    HTTP client as simple request errors.
+    '''
+
+    err_msg_only = RequestErrorHandler.err_msg_only + (
+            aiohttp.ClientConnectorError,
+            aiohttp.ClientResponseError,
+            aiohttp.ServerDisconnectedError,
+            asyncio.TimeoutError)
+
+
+def connection_metrics(ressource: str) -> aiohttp.TraceConfig:
+    '''Create a trace configuration keeping track of how many requests were
+    sent and how many new connections had to be opened for them.
+    '''
+    async def on_request_start(session, context, params):
+        context.new_connection = False
+
+    async def on_connection_create_end(session, context, params):
+        context.new_connection = True
+
+    async def on_request_end(session, context, params):
+        register_http_request(ressource, context.new_connection)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def camera_session(camera: Camera) -> aiohttp.ClientSession:
+    '''Create an HTTP client session for communicating with a camera.
+    Connections are kept alive and the digest authentication nonce is re-used
+    for subsequent requests to the camera.
+    '''
+    auth = None
+    middlewares = ()
+    trace_config = connection_metrics(camera.url)
+    if camera.user and camera.password:
+        if camera.type == CameraType.sony:
+            middlewares = (aiohttp.DigestAuthMiddleware(camera.user,
+                                                        camera.password),)
+        else:
+            auth = aiohttp.BasicAuth(camera.user, camera.password)
+    return aiohttp.ClientSession(auth=auth,
+                                 middlewares=middlewares,
+                                 headers=camera.headers(),
+                                 timeout=timeout,
+                                 trace_configs=[trace_config])
+
+
+def opencast_session() -> aiohttp.ClientSession:
+    '''Create an HTTP client session for communicating with Opencast.
+    '''
+    trace_config = connection_metrics(opencast_server())
+    return aiohttp.ClientSession(auth=aiohttp.BasicAuth(*opencast_auth()),
+                                 timeout=timeout,
+                                 trace_configs=[trace_config])
+
+
+async def perform(camera: Camera, session: aiohttp.ClientSession,
+                  command: CameraCommand):
+    '''Send the requests of a command to the camera one after another.
+    Asynchronous version of :meth:`Camera.perform`.
+    '''
+    try:
+        request = next(command)
+        while True:
+            metric, url, params = request
+            logger.debug('GET %s with params: %s', url, params)
+            with metric.time():
+                async with session.get(url, params=params) as response:
+                    # Read the response to allow the connection to be re-used
+                    body = await response.text()
+            request = command.send((response.status, body))
+    except StopIteration:
+        pass
+
+
+async def execute(camera: Camera, session: aiohttp.ClientSession,
+                  command: Command):
+    '''Send a queued command to the camera.
+    Asynchronous version of :meth:`Camera.execute`.
+    '''
+    await perform(camera, session, camera.command_requests(command))
+
+
+async def verify_agent(agent: Agent, session: aiohttp.ClientSession):
+    '''Verify that an agent exists in Opencast.
+    Asynchronous version of :meth:`Agent.verify_agent`.
+    '''
+    logger.info('Verification of agent `%s`', agent.agent_id)
+    async with session.get(agent.verification_url()) as response:
+        await response.read()
+        if not response.ok:
+            raise LookupError(
+                f'Agent {agent.agent_id} does not exist in Opencast.')
+    logger.debug('Agent %s verified.', agent.agent_id)
+
+
+async def update_calendar(agent: Agent, session: aiohttp.ClientSession):
+    '''Get a calendar update from Opencast.
+    Asynchronous version of :meth:`Agent.update_calendar`.
+    '''
+    url = f'{opencast_server()}/recordings/calendar.json'
+    logger.info('Updating calendar for agent `%s`', agent.agent_id)
+    params = agent.calendar_params()
+    headers = agent.calendar_headers()
+    with agent.fetch_duration.time():
+        async with session.get(url, params=params,
+                               headers=headers) as response:
+            response.raise_for_status()
+            data = await response.read()
+    if response.status == 304:
+        agent.calendar_not_modified()
+        return
+    agent.set_calendar(data,
+                       response.headers.get('ETag'),
+                       response.headers.get('Last-Modified'))
+
+
+async def update_bulk_calendar(calendar: BulkCalendar,
+                               session: aiohttp.ClientSession):
+    '''Get a calendar update for all agents from Opencast.
+    Asynchronous version of :meth:`BulkCalendar.update`.
+    '''
+    logger.info('Updating calendar for all agents')
+    with calendar.fetch_duration.time():
+        async with session.get(calendar.url(),
+                               params=calendar.params(),
+                               headers=calendar.headers(),
+                               timeout=stream_timeout) as response:
+            response.raise_for_status()
+            if response.status == 304:
+                calendar.not_modified()
+                return
+            splitter = calendar.splitter()
+            async for chunk in response.content.iter_chunked(65536):
+                splitter.feed(chunk)
+            splitter.close()
+    calendar.set_calendar(splitter,
+                          response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'))
+
+
+async def update_calendars(agents: list[Agent]):
+    '''Control loop for updating the calendars of all capture agents with a
+    single request on a regular basis
+    '''
+    update_frequency = config_t(int, 'calendar', 'update_frequency') or 120
+    calendar = BulkCalendar(agents)
+    breaker = opencast_breaker()
+    error_handler = AsyncRequestErrorHandler(
+            'calendar',
+            'Failed to update calendar of all agents',
+            breaker)
+
+    async with opencast_session() as session:
+        while True:
+            if breaker.allow():
+                with error_handler:
+                    await update_bulk_calendar(calendar, session)
+            await asyncio.sleep(max(update_frequency, breaker.retry_in()))
+
+
+async def update_agent(agent: Agent, session: aiohttp.ClientSession,
+                       limit: asyncio.Semaphore):
+    '''Control loop for updating the calendar of a single capture agent on a
+    regular basis.
+    '''
+    breaker = opencast_breaker()
+    error_handler = AsyncRequestErrorHandler(
+            agent.agent_id,
+            f'Failed to update calendar of agent {agent.agent_id}',
+            breaker)
+    while True:
+        # Skip updates while Opencast is unreachable
+        if breaker.allow():
+            async with limit:
+                with error_handler:
+                    await update_calendar(agent, session)
+        await asyncio.sleep(agent.calendar_update_delay())
+
+
+async def update_agents(agents: list[Agent]):
+    '''Control loop for updating the capture agent calendars on a regular basis
+    The calendars are updated concurrently with a bounded number of parallel
+    requests and every agent follows its own schedule, so that a slow or
+    unreachable agent does not delay the updates of other agents.
+    '''
+    limit = asyncio.Semaphore(config_t(int, 'calendar', 'workers') or 8)
+    async with opencast_session() as session:
+        await asyncio.gather(*(update_agent(agent, session, limit)
+                               for agent in agents))
+
+
+async def send_commands(camera: Camera, dispatcher: Dispatcher):
+    '''Loop sending the commands queued for a camera once the dispatcher
+    allows it. Failed commands are not retried here. Instead, the control loop
+    is notified to decide which command to send next.
+    '''
+    error_handler = AsyncRequestErrorHandler(
+            camera.url,
+            f'Failed to communicate with camera {camera}',
+            camera.breaker)
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+
+    def notify():
+        # Commands may be queued from other threads like the control server
+        loop.call_soon_threadsafe(wakeup.set)
+
+    camera.commands.subscribe(notify)
+    # Commands may have been queued before subscribing
+    wakeup.set()
+    async with camera_session(camera) as session:
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while pending := camera.commands.peek():
+                # Take the command only when it is dispatched, so that it can
+                # still be replaced by a newer command while waiting
+                dispatched = asyncio.Event()
+
+                def dispatch():
+                    loop.call_soon_threadsafe(dispatched.set)
+
+                dispatcher.request(pending.sort_key(), dispatch)
+                await dispatched.wait()
+                command = camera.commands.get()
+                failed = True
+                with error_handler:
+                    if command:
+                        await execute(camera, session, command)
+                    failed = False
+                dispatcher.release()
+                if failed:
+                    # The camera may have been restarted
+                    camera.set_power(None)
+                    # Back off while the camera is unreachable. The command
+                    # stays active meanwhile, so that the control loop keeps
+                    # waiting.
+                    await asyncio.sleep(camera.breaker.retry_in())
+                camera.commands.done(sent=not failed)
+                # Let the control loop decide about the next command
+                camera.notify()
+
+
+async def control_camera(camera: Camera):
+    '''Control loop to trigger updating the camera position based on currently
+    active events. Commands are queued for the camera and sent by
+    :func:`send_commands`.
+    param camera: Camera object to control
+    '''
+    error_handler = AsyncRequestErrorHandler(
+            camera.url,
+            f'Failed to communicate with camera {camera}')
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+
+    def notify():
+        # Notifications may be sent from other threads like the scheduler
+        loop.call_soon_threadsafe(wakeup.set)
+
+    camera.subscribe(notify)
+    camera.agent.subscribe(notify)
+    while True:
+        wakeup.clear()
+        retry = True
+        with error_handler:
+            if not camera.agent.calendar_initialized:
+                logger.debug('[%s] Calendar not yet initialized…',
+                             camera.agent.agent_id)
+            else:
+                camera.update()
+            retry = False
+
+        # Sleep until the next re-send is due, an error needs to be retried
+        # or until we get notified about a state change
+        timeout = camera.wakeup_timeout(retry)
+        scheduled = time.time() + timeout
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            register_loop_lag('camera', time.time() - scheduled)
+
+
+async def verify(agent: Agent, startup: Startup,
+                 session: aiohttp.ClientSession, limit: asyncio.Semaphore):
+    '''Verify an agent. The verification is retried with an increasing delay
+    until it succeeds.
+    '''
+    error_handler = AsyncRequestErrorHandler(
+            agent.agent_id,
+            f'Failed to verify agent {agent.agent_id}')
+    attempts = 0
+    while True:
+        verified = False
+        async with limit:
+            start = time.time()
+            with error_handler:
+                await verify_agent(agent, session)
+                verified = True
+            duration = time.time() - start
+        if verified:
+            startup.verified(agent, duration)
+            return
+        attempts += 1
+        await asyncio.sleep(startup.failed(agent, duration, attempts))
+
+
+async def start_agent(agent: Agent, cameras: list[Camera],
+                      startup: Startup, dispatcher: Dispatcher,
+                      session: aiohttp.ClientSession,
+                      limit: asyncio.Semaphore):
+    '''Verify an agent and control its cameras. If the calendar of the agent
+    was restored from the snapshot, its cameras are controlled right away,
+    even if Opencast is unavailable, while the agent is verified in
+    parallel. Otherwise, the cameras are controlled once the agent is
+    verified.
+    '''
+    verification = asyncio.ensure_future(
+            verify(agent, startup, session, limit))
+    if not agent.calendar_initialized:
+        await verification
+
+    for camera in cameras:
+        logger.info('Starting camera control for %s with control status %s',
+                    camera, camera.control)
+    await asyncio.gather(verification,
+                         *(control_camera(camera)
+                           for camera in cameras),
+                         *(send_commands(camera, dispatcher)
+                           for camera in cameras))
+
+
+async def start_agents(agents: list[Agent], cameras: list[Camera],
+                       startup: Startup, dispatcher: Dispatcher):
+    '''Verify all agents concurrently with a bounded number of parallel
+    requests and control the cameras of each agent as soon as it is verified.
+    '''
+    limit = asyncio.Semaphore(config_t(int, 'calendar', 'workers') or 8)
+    async with opencast_session() as session:
+        await asyncio.gather(*(
+            start_agent(agent, [c for c in cameras if c.agent is agent],
+                        startup, dispatcher, session, limit)
+            for agent in agents))
+
+
+async def run(agents: list[Agent], cameras: list[Camera],
+              startup: Startup, dispatcher: Dispatcher):
+    '''Run the calendar updates and the control loops of all cameras
+    concurrently within the current event loop.
+    '''
+    if config_t(bool, 'calendar', 'bulk'):
+        calendar_update = update_calendars(agents)
+    else:
+        calendar_update = update_agents(agents)
+    await asyncio.gather(calendar_update,
+                         start_agents(agents, cameras, startup, dispatcher))
+
+
+def start(agents: list[Agent], cameras: list[Camera],
+          startup: Startup, dispatcher: Dispatcher):
+    '''Start the asynchronous control engine. This blocks until the event loop
+    terminates and is meant to be run in its own thread.
+    '''
+    asyncio.run(run(agents, cameras, startup, dispatcher))
@@ -0,0 +1,215 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import codecs
+import hashlib
+import json
+import logging
+import re
+
+from typing import Any, Optional
+
+from occameracontrol.agent import Agent, calendar_cutoff, \
+        conditional_headers, opencast_server, opencast_session
+from occameracontrol.metrics import calendar_fetch_metric
+
+
+logger = logging.getLogger(__name__)
+
+# Whitespace and separators between the items of a JSON array
+separator = re.compile(r'[\s,]*')
+
+
+class CalendarSplitter:
+    '''Incremental parser splitting the calendar of all capture agents into
+    the events of each agent in a single pass. Data can be fed in chunks as it
+    is received and only the fields required for the events of the given
+    agents are kept, so the complete calendar never needs to be held in
+    memory::
+
+        splitter = CalendarSplitter({'agent1', 'agent2'})
+        for chunk in response.iter_content(chunk_size=65536):
+            splitter.feed(chunk)
+        splitter.close()
+    '''
+
+    def __init__(self, agent_ids: Optional[set[str]] = None):
+        '''Create a CalendarSplitter instance.
+
+        :param agent_ids: Agents to keep the events of (default: all agents)
+        '''
+        self.agent_ids = agent_ids
+        self.events: dict[str, list] = {}
+        self.hashes: dict[str, Any] = {}
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._started = False
+        self._finished = False
+
+    def feed(self, chunk: bytes):
+        '''Parse the next chunk of calendar data.
+        '''
+        self._buffer += self._utf8.decode(chunk)
+        self._parse()
+
+    def close(self):
+        '''Finish parsing the calendar data.
+
+        :raises ValueError: if the calendar data is incomplete
+        '''
+        self._buffer += self._utf8.decode(b'', final=True)
+        self._parse()
+        if not self._finished:
+            raise ValueError('Calendar data is incomplete')
+
+    def _parse(self):
+        '''Parse all complete events from the buffer.
+        '''
+        buffer = self._buffer
+        position = 0
+        while not self._finished:
+            match = separator.match(buffer, position)
+            if match:
+                position = match.end()
+            if position >= len(buffer):
+                break
+            if not self._started:
+                if buffer[position] != '[':
+                    raise ValueError('Calendar data is not a JSON array')
+                self._started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                self._finished = True
+                break
+            try:
+                item, end = self._decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Incomplete item. Wait for more data.
+                break
+            self._add(item, buffer[position:end])
+            position = end
+        self._buffer = buffer[position:]
+
+    def _add(self, item: dict, raw: str):
+        '''Add a single event to the events of its capture agent.
+        '''
+        data = item['data']
+        agent_config = data['agentConfig']
+        agent_id = agent_config.get('event.location')
+        if self.agent_ids is not None and agent_id not in self.agent_ids:
+            return
+        if agent_id not in self.hashes:
+            self.events[agent_id] = []
+            self.hashes[agent_id] = hashlib.sha256()
+        # Keep only what is required to create the event
+        self.events[agent_id].append({'data': {
+            'startDate': data['startDate'],
+            'endDate': data['endDate'],
+            'agentConfig': {'event.title': agent_config['event.title']}}})
+        self.hashes[agent_id].update(raw.encode())
+
+    def calendar_hash(self, agent_id: str) -> bytes:
+        '''Returns the hash of the raw calendar data of an agent.
+        '''
+        calendar_hash = self.hashes.get(agent_id) or hashlib.sha256()
+        return calendar_hash.digest()
+
+
+class BulkCalendar:
+    '''Calendar of all capture agents requested from Opencast at once and
+    split up into the calendars of the individual agents.
+    '''
+    agents: list[Agent]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def __init__(self, agents: list[Agent]):
+        self.agents = agents
+        self.fetch_duration = calendar_fetch_metric('all')
+
+    def url(self) -> str:
+        '''Returns the URL of the calendar endpoint.
+        '''
+        return f'{opencast_server()}/recordings/calendar.json'
+
+    def params(self) -> dict:
+        '''Returns the query parameters for requesting the calendar of all
+        agents from Opencast.
+        '''
+        return {'cutoff': calendar_cutoff()}
+
+    def headers(self) -> dict[str, str]:
+        '''Returns the headers for conditionally requesting the calendar from
+        Opencast, based on the last calendar received.
+        '''
+        return conditional_headers(self.etag, self.last_modified)
+
+    def splitter(self) -> CalendarSplitter:
+        '''Returns a parser for the calendar data, keeping only the events
+        of the configured agents.
+        '''
+        return CalendarSplitter({agent.agent_id for agent in self.agents})
+
+    def update(self):
+        '''Get a calendar update for all agents from Opencast
+        '''
+        logger.info('Updating calendar for all agents')
+        with self.fetch_duration.time():
+            response = opencast_session().get(self.url(),
+                                              params=self.params(),
+                                              headers=self.headers(),
+                                              stream=True,
+                                              timeout=5)
+            with response:
+                response.raise_for_status()
+                if response.status_code == 304:
+                    self.not_modified()
+                    return
+                splitter = self.splitter()
+                for chunk in response.iter_content(chunk_size=65536):
+                    splitter.feed(chunk)
+                splitter.close()
+        self.set_calendar(splitter,
+                          response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'))
+
+    def not_modified(self):
+        '''Record a calendar update which did not change the calendar.
+        '''
+        for agent in self.agents:
+            agent.calendar_not_modified()
+
+    def set_calendar(self, splitter: CalendarSplitter,
+                     etag: Optional[str] = None,
+                     last_modified: Optional[str] = None):
+        '''Hand the calendar data of each agent to the agent. Agents whose
+        calendar did not change will skip parsing their events.
+
+        :param splitter: Parser which has processed the calendar data
+        :param etag: ETag header of the calendar response
+        :param last_modified: Last-Modified header of the calendar response
+        '''
+        self.etag = etag
+        self.last_modified = last_modified
+        for agent in self.agents:
+            calendar_hash = splitter.calendar_hash(agent.agent_id)
+            if calendar_hash == agent.calendar_hash:
+                agent.calendar_not_modified()
+                continue
+            agent.set_events(splitter.events.get(agent.agent_id, []),
+                             calendar_hash)
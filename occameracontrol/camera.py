@@ -16,21 +16,45 @@
 
 import datetime
 import logging
+import re
 import requests
-import time
+import threading
 
 from confygure import config_t
 from enum import Enum
 from requests.auth import HTTPDigestAuth
-from typing import Optional
+from typing import Any, Callable, Generator, Optional, Union
 
+from occameracontrol import clock
 from occameracontrol.agent import Agent
-from occameracontrol.metrics import register_camera_move, \
-        register_camera_expectation
+from occameracontrol.command_queue import Command, CommandQueue
+from occameracontrol.metrics import register_camera_actual, \
+        register_command_suppressed, CircuitBreaker, CommandMetrics, \
+        ConnectionMetricsAdapter
 
 
 logger = logging.getLogger(__name__)
 
+# Power state in responses to Sony system inquiries
+sony_power = re.compile(r'Power=["\']?(\w+)')
+# Last recalled preset in responses to Panasonic and Sony inquiries
+panasonic_preset = re.compile(r's(\d\d)')
+sony_preset = re.compile(r'PresetCall=["\']?(\d+)')
+
+# Request to a camera: histogram to record the round-trip time in, URL and
+# query parameters
+CameraRequest = tuple[Any, str, dict]
+# Camera commands are generators yielding the requests to send and receiving
+# status code and body of each response, so that the same logic can be used
+# with any HTTP client
+CameraCommand = Generator[CameraRequest, tuple[int, str], None]
+
+
+def http_error(status: int, url: str) -> requests.exceptions.HTTPError:
+    '''Returns the error to raise for a failed request to a camera.
+    '''
+    return requests.exceptions.HTTPError(f'{status} Error for url: {url}')
+
 
 class CameraType(Enum):
     '''Enumm with supported camera manufacturer types
@@ -52,6 +76,19 @@ class Camera:
     preset_inactive: int = 10
     last_updated: float = 0.0
     update_frequency: int = 300
+    # Last known power state or `None` if unknown
+    power: Optional[bool] = None
+    power_checked: float = 0.0
+    power_check_frequency: int = 600
+    # Query the position before re-sending it instead of moving blindly
+    verify_position: bool = False
+    # Seconds to move the camera ahead of the start of an event
+    lead_time: int = 0
+    # Extend the lead time by the measured duration of camera moves
+    learn_lead_time: bool = False
+    # Smoothed duration of waking up and moving the camera in seconds
+    move_duration: Optional[float] = None
+    move_started: float = 0.0
     # Flag for switching between automatic and manual camera control
     # automatic  = The corresponding camera will be controlled automatically,
     #              i.e. the camera position will be adjusted
@@ -61,6 +98,11 @@ class Camera:
     #              Values in preset_active and preset_inactive will
     #              be ignored as well as the agent's status
     control: str = "automatic"
+    listeners: list[Callable[[], None]]
+    commands: CommandQueue
+    breaker: CircuitBreaker
+    metrics: CommandMetrics
+    session: requests.Session
 
     def __init__(self,
                  agent: Agent,
@@ -79,124 +121,458 @@ class Camera:
         self.preset_active = preset_active
         self.preset_inactive = preset_inactive
         self.update_frequency = config_t(int, 'camera_update_frequency') or 300
+        self.power_check_frequency = \
+            config_t(int, 'camera_power_check_frequency') or 600
+        self.verify_position = bool(config_t(bool, 'camera_verify_position'))
+        self.lead_time = config_t(int, 'camera_lead_time') or 0
+        self.learn_lead_time = \
+            bool(config_t(bool, 'camera_lead_time_learning'))
         self.control = control
+        self.listeners = []
+        # Guards control status changes against concurrent control decisions
+        self._control_lock = threading.Lock()
+        # Notified whenever the camera reaches a preset
+        self._moved = threading.Condition()
+        self.commands = CommandQueue(self.url)
+        self.breaker = CircuitBreaker(self.url)
+        self.metrics = CommandMetrics(self.url)
+
+        # Keep connections alive and re-use the digest authentication nonce
+        # for subsequent requests to the camera
+        self.session = requests.Session()
+        self.session.auth = self.auth()
+        self.session.headers.update(self.headers())
+        adapter = ConnectionMetricsAdapter(self.url)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def __str__(self) -> str:
         '''Returns a string representation of this camera
         '''
         return f"'{self.agent.agent_id}' @ '{self.url}'"
 
+    def subscribe(self, callback: Callable[[], None]):
+        '''Register a callback which is called whenever the camera needs to
+        be handled by its control loop right away, e.g. because its control
+        status was changed.
+        '''
+        self.listeners.append(callback)
+
+    def notify(self):
+        '''Wake up the control loop of this camera.
+        '''
+        for callback in self.listeners:
+            callback()
+
+    def set_control(self, control: str):
+        '''Switch the camera between manual and automatic control. The
+        position is reset so that it is re-sent, and the control loop is
+        woken up to apply the change right away. Pending commands are dropped
+        so that a camera switched to manual control is not moved anymore.
+
+        :param control: New control status (`manual` or `automatic`)
+        '''
+        with self._control_lock:
+            self.control = control
+            self.position = -1
+            self.commands.clear()
+        self.notify()
+
+    def wait_for_position(self, since: float, timeout: float
+                          ) -> Optional[float]:
+        '''Wait until the camera reached the preset it is expected to be at
+        and return the number of seconds this took, measured from `since`.
+        Returns `None` if the camera did not reach its expected preset within
+        the timeout or if it is controlled manually.
+
+        :param since: Point in time to measure the latency from
+        :param timeout: Maximum number of seconds to wait
+        '''
+        if self.control != 'automatic':
+            return None
+        with self._moved:
+            reached = self._moved.wait_for(
+                    lambda: self.position == self.expected_position(),
+                    timeout)
+        if not reached:
+            return None
+        return max(self.last_updated - since, 0.0)
+
+    def auth(self) -> Union[tuple[str, str], HTTPDigestAuth, None]:
+        '''Returns the authentication to use for requests to this camera.
+        Panasonic cameras use basic authentication while Sony cameras require
+        digest authentication.
+        '''
+        if not (self.user and self.password):
+            return None
+        if self.type == CameraType.sony:
+            return HTTPDigestAuth(self.user, self.password)
+        return (self.user, self.password)
+
+    def headers(self) -> dict[str, str]:
+        '''Returns additional HTTP headers required by this camera.
+        '''
+        if self.type == CameraType.sony:
+            return {'referer': f'{self.url}/index.html'}
+        return {}
+
+    def power_command(self, on: bool = True) -> tuple[str, dict]:
+        '''Returns URL and parameters of the command for activating the camera
+        or putting it into standby mode.
+        :param bool on: camera should be online or standby (default: True)
+        '''
+        if self.type == CameraType.panasonic:
+            command = '#On' if on else '#Of'
+            return f'{self.url}/cgi-bin/aw_ptz', {'cmd': command, 'res': 1}
+        command = 'on' if on else 'standby'
+        return f'{self.url}/command/main.cgi', {'System': command}
+
+    def power_query(self) -> tuple[str, dict]:
+        '''Returns URL and parameters of the request for querying the power
+        state of the camera.
+        '''
+        if self.type == CameraType.panasonic:
+            return f'{self.url}/cgi-bin/aw_ptz', {'cmd': '#O', 'res': 1}
+        return f'{self.url}/command/inquiry.cgi', {'inq': 'system'}
+
+    def parse_power_state(self, body: str) -> Optional[bool]:
+        '''Parse the response to a power state query.
+        Returns `True` if the camera is on or turning on, `False` if it is in
+        standby mode and `None` if the state is unknown.
+        '''
+        if self.type == CameraType.panasonic:
+            # p1 = on, p3 = turning on, p0 = standby
+            state = body.strip()
+            if state in ('p1', 'p3'):
+                return True
+            return False if state == 'p0' else None
+        match = sony_power.search(body)
+        if not match:
+            return None
+        return match.group(1) == 'on'
+
+    def power_confirmed(self, on: bool = True) -> bool:
+        '''Returns whether the camera is known to be in the requested power
+        state and the state was confirmed recently enough for a power command
+        to be skipped.
+        '''
+        return self.power == on and \
+            clock.now() - self.power_checked < self.power_check_frequency
+
+    def set_power(self, on: Optional[bool]):
+        '''Record the power state of the camera.
+        :param on: New power state or `None` if the state is unknown
+        '''
+        self.power = on
+        self.power_checked = clock.now()
+
+    def position_query(self) -> tuple[str, dict]:
+        '''Returns URL and parameters of the request for querying the preset
+        the camera was last moved to.
+        '''
+        if self.type == CameraType.panasonic:
+            return f'{self.url}/cgi-bin/aw_ptz', {'cmd': '#S', 'res': 1}
+        return f'{self.url}/command/inquiry.cgi', {'inq': 'presetposition'}
+
+    def parse_position(self, body: str) -> Optional[int]:
+        '''Parse the response to a position query.
+        Returns the preset the camera was last moved to or `None` if it is
+        unknown.
+        '''
+        if self.type == CameraType.panasonic:
+            match = panasonic_preset.fullmatch(body.strip())
+            # Panasonic presets are zero-based
+            return int(match.group(1)) + 1 if match else None
+        match = sony_preset.search(body)
+        return int(match.group(1)) if match else None
+
+    def position_verified(self, preset: int, actual: Optional[int]) -> bool:
+        '''Record the position the camera reported and return whether it is
+        at the expected preset, so that the preset does not need to be
+        re-sent.
+        :param preset: Expected preset
+        :param actual: Reported preset or `None` if it is unknown
+        '''
+        if actual is None:
+            logger.warning('[%s] Could not query camera position, '
+                           're-sending preset %i', self.agent.agent_id, preset)
+            return False
+        register_camera_actual(self.url, actual)
+        if actual != preset:
+            logger.warning('[%s] Camera is at preset %i instead of %i',
+                           self.agent.agent_id, actual, preset)
+            return False
+        self.last_updated = clock.now()
+        return True
+
+    def preset_command(self, preset: int) -> tuple[str, dict]:
+        '''Returns URL and parameters of the command for moving the camera to
+        the specified preset position.
+        '''
+        if self.type == CameraType.panasonic:
+            params = {'cmd': f'#R{preset - 1:02}', 'res': 1}
+            return f'{self.url}/cgi-bin/aw_ptz', params
+        params = {'PresetCall': f'{preset},24'}
+        return f'{self.url}/command/presetposition.cgi', params
+
+    def power_requests(self, on: bool = True) -> CameraCommand:
+        """Requests for activating the camera or putting it into standby
+        mode. The command is skipped if the camera is known to be in the
+        requested state already. If the known state is outdated, the camera
+        is queried for its state first.
+        :param bool on: camera should be online or standby (default: True)
+        """
+        if self.power_confirmed(on):
+            register_command_suppressed(self.url)
+            return
+        if self.power == on:
+            status, body = yield (self.metrics.power_query,
+                                  *self.power_query())
+            if status < 400 and self.parse_power_state(body) == on:
+                self.set_power(on)
+                register_command_suppressed(self.url)
+                return
+
+        url, params = self.power_command(on)
+        status, _ = yield self.metrics.power, url, params
+        if status >= 400:
+            if self.type != CameraType.sony:
+                raise http_error(status, url)
+            logger.error('Failed to activate camera: %s',
+                         http_error(status, url))
+            return
+        self.set_power(on)
+
+    def preset_requests(self, preset: int) -> CameraCommand:
+        '''Requests for moving the PTZ camera to the specified preset
+        position.
+        '''
+        self.moving_to(preset)
+        yield from self.power_requests()
+        url, params = self.preset_command(preset)
+        status, _ = yield self.metrics.preset, url, params
+        if status >= 400:
+            raise http_error(status, url)
+        self.moved_to(preset)
+
+    def probe_requests(self) -> CameraCommand:
+        '''Request for checking if the camera is reachable using the cheap
+        power state query.
+        '''
+        url, params = self.power_query()
+        status, _ = yield self.metrics.power_query, url, params
+        if status >= 400:
+            raise http_error(status, url)
+
+    def position_requests(self, preset: int) -> CameraCommand:
+        '''Requests for querying the position of the camera and only moving
+        it to the specified preset if it is not there already.
+        '''
+        status, body = yield (self.metrics.position_query,
+                              *self.position_query())
+        actual = self.parse_position(body) if status < 400 else None
+        if not self.position_verified(preset, actual):
+            yield from self.preset_requests(preset)
+
+    def command_requests(self, command: Command) -> CameraCommand:
+        '''Requests for sending a queued command to the camera. If the
+        camera was unreachable before, it is probed first.
+        '''
+        if self.breaker.state != 'closed':
+            yield from self.probe_requests()
+        if command.preset is None:
+            yield from self.power_requests()
+        elif command.verify:
+            yield from self.position_requests(command.preset)
+        else:
+            yield from self.preset_requests(command.preset)
+
+    def request(self, metric, url: str, params: dict) -> tuple[int, str]:
+        '''Send a request to the camera and return status code and body of
+        the response.
+
+        :param metric: Histogram of :attr:`metrics` to record the time in
+        :param url: URL of the request
+        :param params: Query parameters of the request
+        '''
+        logger.debug('GET %s with params: %s', url, params)
+        with metric.time():
+            response = self.session.get(url, params=params, timeout=5)
+        return response.status_code, response.text
+
+    def perform(self, command: CameraCommand):
+        '''Send the requests of a command to the camera one after another.
+        '''
+        try:
+            request = next(command)
+            while True:
+                request = command.send(self.request(*request))
+        except StopIteration:
+            pass
+
     def activate_camera(self, on=True):
         """Activate the camera or put it into standby mode.
         :param bool on: camera should be online or standby (default: True)
         """
-        if self.type == CameraType.panasonic:
-            url = f'{self.url}/cgi-bin/aw_ptz'
-            command = '#On' if on else '#Of'
-            params = {'cmd': command, 'res': 1}
-            auth = (self.user, self.password) \
-                if self.user and self.password else None
-            logger.debug('GET %s with params: %s', url, params)
-            response = requests.get(url, auth=auth, params=params, timeout=5)
-            response.raise_for_status()
-
-        elif self.type == CameraType.sony:
-            url = f'{self.url}/command/main.cgi'
-            command = 'on' if on else 'standby'
-            params = {'System': command}
-            headers = {'referer': f'{self.url}/index.html'}
-            auth = HTTPDigestAuth(self.user, self.password) \
-                if self.user and self.password else None
-            logger.debug('GET %s with params: %s', url, params)
-            response = requests.get(url,
-                                    auth=auth,
-                                    headers=headers,
-                                    params=params,
-                                    timeout=5)
-            try:
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                logger.error('Failed to activate camera: %s', e)
+        self.perform(self.power_requests(on))
 
     def move_to_preset(self, preset: int):
         '''Move the PTZ camera to the specified preset position
         '''
-        self.activate_camera()
-        register_camera_expectation(self.url, preset)
-        if self.type == CameraType.panasonic:
-            params = {'cmd': f'#R{preset - 1:02}', 'res': 1}
-            url = f'{self.url}/cgi-bin/aw_ptz'
-            auth = (self.user, self.password) \
-                if self.user and self.password else None
-            logger.debug('GET %s with params: %s', url, params)
-            response = requests.get(url, auth=auth, params=params, timeout=5)
-            response.raise_for_status()
-
-        elif self.type == CameraType.sony:
-            url = f'{self.url}/command/presetposition.cgi'
-            params = {'PresetCall': f'{preset},24'}
-            headers = {'referer': f'{self.url}/index.html'}
-            auth = HTTPDigestAuth(self.user, self.password) \
-                if self.user and self.password else None
-            logger.debug('GET %s with params: %s', url, params)
-            response = requests.get(url,
-                                    auth=auth,
-                                    headers=headers,
-                                    params=params,
-                                    timeout=5)
-            response.raise_for_status()
-
-        self.position = preset
-        register_camera_move(self.url, preset)
-        self.last_updated = time.time()
+        self.perform(self.preset_requests(preset))
+
+    def execute(self, command: Command):
+        '''Send a queued command to the camera.
+        '''
+        self.perform(self.command_requests(command))
+
+    def moving_to(self, preset: int):
+        '''Record that the camera is about to be moved to a preset position.
+        '''
+        self.move_started = clock.now()
+
+    def moved_to(self, preset: int):
+        '''Record that the camera was successfully moved to a preset position.
+        '''
+        with self._moved:
+            self.position = preset
+            self.last_updated = clock.now()
+            self._moved.notify_all()
+
+        duration = self.last_updated - self.move_started
+        if self.move_duration is None:
+            self.move_duration = duration
+        else:
+            self.move_duration = 0.7 * self.move_duration + 0.3 * duration
+
+    def current_lead_time(self) -> float:
+        '''Returns the number of seconds ahead of the start of an event the
+        camera should be moved to its active position.
+        '''
+        if self.learn_lead_time and self.move_duration is not None:
+            return self.lead_time + self.move_duration
+        return self.lead_time
+
+    def next_update(self) -> float:
+        '''Returns the point in time at which the current position needs to
+        be re-sent to the camera.
+        In manual mode, this is the time when the camera should be
+        re-activated.
+        '''
+        if self.control == 'automatic':
+            next_update = self.last_updated + self.update_frequency
+            # Wake up in time to move the camera ahead of the next event
+            lead_time = self.current_lead_time()
+            if lead_time:
+                start = self.agent.next_event().start - lead_time
+                if start > clock.now():
+                    next_update = min(next_update, start)
+            return next_update
+        return clock.now() + self.update_frequency
+
+    def wakeup_timeout(self, retry: bool = False) -> float:
+        '''Returns the number of seconds the control loop may sleep until the
+        next re-send is due. While a command is queued or sent, the control
+        loop gets notified once it is done.
+
+        :param retry: If the last update failed and needs to be retried
+        '''
+        if retry:
+            return 1
+        if not self.commands.empty() or not self.agent.calendar_initialized:
+            return self.update_frequency
+        return max(self.next_update() - clock.now(), 1)
 
     def from_now(self, ts: float) -> str:
         '''Get a string representation of the time until the provided time
         stamp is reached.
         '''
-        seconds = int(ts - time.time())  # seconds are enough accuracy
+        seconds = int(ts - clock.now())  # seconds are enough accuracy
         return str(datetime.timedelta(seconds=seconds))
 
     def check_calendar(self):
-        agent_id = self.agent.agent_id
-        level = logging.DEBUG if int(time.time()) % 60 else logging.INFO
-
-        while not self.agent.calendar_initialized:
-            logger.log(level, '[%s] Calendar not yet initialized…', agent_id)
-            time.sleep(1)
-
-        event = self.agent.next_event()
-        if event.future():
-            logger.log(level, '[%s] Next event `%s` starts in %s',
-                       agent_id, event.title[:40], self.from_now(event.start))
-        elif event.active():
-            logger.log(level, '[%s] Active event `%s` ends in %s',
-                       agent_id, event.title[:40], self.from_now(event.end))
-        else:
-            logger.log(level, '[%s] No planned events', agent_id)
+        '''Returns the current or next event of the camera's agent.
+        The agent's state is evaluated and logged once per state transition
+        for all of its cameras.
+        '''
+        return self.agent.next_event()
 
-        return event
+    def expected_position(self) -> Optional[int]:
+        '''Returns the preset the camera should be at according to the
+        calendar of its agent. Returns `None` if the camera is controlled
+        manually or if the calendar is not yet known.
+        '''
+        if self.control != 'automatic' or not self.agent.calendar_initialized:
+            return None
+        if self.agent.next_event().active(self.current_lead_time()):
+            return self.preset_active
+        return self.preset_inactive
 
-    def update_position(self):
+    def target_position(self) -> Optional[int]:
         '''Check for currently active events with the camera's capture agent
-        and move the camera to the appropriate (active, inactive) position if
-        necessary.
+        and return the preset the camera needs to be moved to or re-sent.
+        Returns `None` if no command needs to be sent to the camera.
         '''
         agent_id = self.agent.agent_id
         event = self.check_calendar()
-        if event.active():  # active event
+        if event.active(self.current_lead_time()):  # active event
+            if self.commands.target() == self.preset_active:
+                return None
             if self.position != self.preset_active:
-                logger.info('[%s] Event `%s` started', agent_id, event.title)
+                if event.active():
+                    logger.info('[%s] Event `%s` started', agent_id,
+                                event.title)
+                else:
+                    logger.info('[%s] Event `%s` starts in %s', agent_id,
+                                event.title, self.from_now(event.start))
                 logger.info('[%s] Moving to preset %i', agent_id,
                             self.preset_active)
-                self.move_to_preset(self.preset_active)
+                return self.preset_active
         else:  # No active event
+            if self.commands.target() == self.preset_inactive:
+                return None
             if self.position != self.preset_inactive:
                 logger.info('[%s] Returning to preset %i', agent_id,
                             self.preset_inactive)
-                self.move_to_preset(self.preset_inactive)
+                return self.preset_inactive
+
+        if clock.now() - self.last_updated >= self.update_frequency:
+            if self.verify_position:
+                logger.debug('[%s] Verifying preset %i', agent_id,
+                             self.position)
+            else:
+                logger.info('[%s] Re-sending preset %i to camera', agent_id,
+                            self.position)
+            return self.position
+        return None
 
-        if time.time() - self.last_updated >= self.update_frequency:
-            logger.info('[%s] Re-sending preset %i to camera', agent_id,
-                        self.position)
-            self.move_to_preset(self.position)
+    def update(self):
+        '''Queue the command required by the current control status. In
+        automatic mode, the camera is moved according to the calendar. In
+        manual mode, the camera is only kept turned on.
+        '''
+        with self._control_lock:
+            if self.control == 'automatic':
+                self.update_position()
+            else:
+                self.commands.put(Command())
+
+    def update_position(self):
+        '''Check for currently active events with the camera's capture agent
+        and queue a command to move the camera to the appropriate (active,
+        inactive) position if necessary. If position verification is
+        enabled, the current position is verified instead of re-sent.
+        '''
+        preset = self.target_position()
+        if preset is None:
+            return
+        if preset == self.position:
+            command = Command(preset, self.verify_position)
+        elif preset == self.preset_active:
+            # Move cameras to their active position first, in the order in
+            # which their events started
+            command = Command(preset, priority=0,
+                              due=self.agent.next_event().start)
+        else:
+            command = Command(preset, priority=1)
+        self.commands.put(command)
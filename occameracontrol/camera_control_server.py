@@ -15,76 +15,249 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import re
+import threading
+import time
+import waitress
 
-from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
-from flask import Flask, Response
+from confygure import config_t
+from prometheus_client import CONTENT_TYPE_LATEST
+from flask import Flask, Response, jsonify, request
 from flask_basicauth import BasicAuth
+from typing import Optional
+
+from occameracontrol import clock
+from occameracontrol.camera import Camera
+from occameracontrol.collector import CachedExposition
 
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 basic_auth = BasicAuth(app)
 
+# Scheme of camera URLs which is ignored when comparing URLs
+url_scheme = re.compile(r'^https?:/+')
+
+# Maximum number of seconds a request may wait for cameras to be moved
+max_wait = 60
+
+
+def normalize_url(url: str) -> str:
+    '''Returns the camera URL without scheme and trailing slashes to ensure
+    reliable comparability.
+    '''
+    return url_scheme.sub('', url).rstrip('/')
+
+
+def index_cameras(cameras: list[Camera]) -> dict[str, list[Camera]]:
+    '''Build an index mapping the normalized URL of each camera to the camera
+    and each agent identifier to the cameras of the agent.
+    '''
+    index: dict[str, list[Camera]] = {}
+    for camera in cameras:
+        index.setdefault(camera.agent.agent_id, []).append(camera)
+    # Camera URLs take precedence over agent identifiers
+    for camera in cameras:
+        index[normalize_url(camera.url)] = [camera]
+    return index
+
+
+def find_cameras(identifier: str) -> list[Camera]:
+    '''Returns the camera with the given URL or all cameras of the agent with
+    the given identifier.
+    '''
+    return app.config['camera_index'].get(normalize_url(identifier), [])
+
 
-@app.route('/control/<string:status>/<string:req_camera_url>')
+def camera_status(camera: Camera) -> dict:
+    '''Returns the status of a camera for JSON responses.
+    '''
+    return {'url': camera.url,
+            'agent': camera.agent.agent_id,
+            'control': camera.control,
+            'position': camera.position,
+            'expected_position': camera.expected_position(),
+            'last_updated': camera.last_updated or None}
+
+
+def wait_parameter() -> Optional[float]:
+    '''Returns the number of seconds to wait for cameras to reach their
+    expected position as requested by the `wait` query parameter. Returns
+    `None` if the client does not want to wait.
+    Raises a ValueError if the parameter is invalid.
+    '''
+    wait = request.args.get('wait')
+    if wait is None:
+        return None
+    wait = float(wait)
+    if not 0 <= wait <= max_wait:
+        raise ValueError(f'Invalid wait time {wait}')
+    return wait
+
+
+def set_control(cameras: list[Camera], status: str, wait: Optional[float]
+                ) -> Optional[list[dict]]:
+    '''Switch the given cameras to manual or automatic control and return
+    their status. If `wait` is set, wait up to this number of seconds for
+    the cameras to reach their expected position and include the latency of
+    reaching it. Waiting requests block a server thread, so their number is
+    limited. Returns `None` without switching any camera if too many
+    requests are waiting already.
+    '''
+    waiting = app.config['waiting']
+    if wait is not None and not waiting.acquire(blocking=False):
+        return None
+    try:
+        started = clock.now()
+        deadline = time.time() + (wait or 0)
+        for camera in cameras:
+            camera.set_control(status)
+
+        result = [camera_status(camera) for camera in cameras]
+        if wait is not None:
+            for camera, state in zip(cameras, result):
+                timeout = max(deadline - time.time(), 0)
+                state['latency'] = camera.wait_for_position(started, timeout)
+                state.update(camera_status(camera))
+        return result
+    finally:
+        if wait is not None:
+            waiting.release()
+
+
+def respond(message: str, data: dict, status: int = 200):
+    '''Create a response which is JSON if requested by the client via the
+    `Accept` header or the `format=json` query parameter and HTML otherwise.
+    '''
+    if request.args.get('format') == 'json' or \
+            request.accept_mimetypes.best == 'application/json':
+        return jsonify(data), status
+    return message, status
+
+
+@app.route('/control/<string:status>/<path:req_camera_url>')
 @basic_auth.required
 def activate_camera(status, req_camera_url):
     """ Endpoint for switching between manual and automatic camera control.
-        The desired camera is identified by the passed req_camera_url.
+        The desired camera is identified by the passed req_camera_url. If an
+        agent identifier is passed instead, all cameras of the agent are
+        switched. With `?wait=<seconds>`, the response is delayed until the
+        cameras reached their expected position.
     """
+    if status not in ('manual', 'automatic'):
+        return respond(f'ERROR<br/>Given status {status} is invalid.',
+                       {'error': f'Invalid status {status}'}, 400)
+    try:
+        wait = wait_parameter()
+    except ValueError as e:
+        return respond(f'ERROR<br/>{e}', {'error': str(e)}, 400)
+
+    cameras = find_cameras(req_camera_url)
+    if not cameras:
+        logger.info("Camera with url '%s' could not be found.",
+                    req_camera_url)
+        return respond(
+                f"ERROR<br/>Camera with url '{req_camera_url}' could not be "
+                "found.",
+                {'error': f'Camera {req_camera_url} not found'}, 404)
+
     if status == "manual":
         logger.info('Camera with URL "[%s]" will be controlled manually and ' +
                     'therefore it\'s position won\'t be updated automatically',
                     req_camera_url)
-    elif status == "automatic":
+    else:
         logger.info('Camera with URL "[%s]" will switch to automatic ' +
                     'controlling. The camera\'s position will be ' +
                     'adjusted to the corresponding agent\'s status ' +
                     'automatically.', req_camera_url)
-    else:
-        return 'ERROR<br/>Given status %s is invalid.', status
 
-    # Get rid of http or https prefixes to ensure reliable comparability
-    sanitized_camera_url = (req_camera_url.replace('http://', '')
-                            .replace('https://', ''))
-    cameras = app.config["cameras"]
-    for camera in cameras:
-        camera_url = (getattr(camera, 'url').replace('http://', '')
-                      .replace('https://', ''))
-        if sanitized_camera_url == camera_url:
-            setattr(camera, 'control', status)
-            # Resets the current position of the camera
-            setattr(camera, 'position', -1)
-            return (
-                f"Successfully set camera with url '{camera_url} "
-                f"to control status <b>'{status}'</b>."
-            )
-    logger.info(f"Camera with url '{req_camera_url}' could not be found.")
-    return f"ERROR<br/>Camera with url '{req_camera_url}' could not be found."
-
-
-@app.route('/control_status/<string:req_camera_url>')
+    result = set_control(cameras, status, wait)
+    if result is None:
+        return respond('ERROR<br/>Too many requests are waiting for cameras.',
+                       {'error': 'Too many waiting requests'}, 503)
+    return respond(
+            f"Successfully set camera with url '{req_camera_url}' "
+            f"to control status <b>'{status}'</b>.",
+            {'cameras': result})
+
+
+@app.route('/control_status/<path:req_camera_url>')
 @basic_auth.required
 def view_current_camera_control_status(req_camera_url):
     """ Endpoint for requesting the current control status
         (manual or automatic) for a camera.
         The desired camera is identified by the passed camera url.
     """
-    # Get rid of http or https prefixes to ensure reliable comparability
-    sanitized_camera_url = (req_camera_url.replace('http://', '')
-                            .replace('https://', ''))
-    cameras = app.config["cameras"]
-    for camera in cameras:
-        camera_url = (getattr(camera, 'url').replace('http://', '')
-                      .replace('https://', ''))
-        if sanitized_camera_url == camera_url:
-            return (
-                f"STATUS<br/>The control status of the camera "
-                f"with url '{req_camera_url}' is "
-                f"<b>{getattr(camera, 'control')}</b>"
-            )
-    logger.info(f"Camera with url '{req_camera_url}' could not be found.")
-    return f"ERROR</br>Camera with url '{req_camera_url}' could not be found."
+    cameras = find_cameras(req_camera_url)
+    if not cameras:
+        logger.info("Camera with url '%s' could not be found.",
+                    req_camera_url)
+        return respond(
+                f"ERROR</br>Camera with url '{req_camera_url}' could not be "
+                "found.",
+                {'error': f'Camera {req_camera_url} not found'}, 404)
+    control = ', '.join(sorted({camera.control for camera in cameras}))
+    return respond(
+            f"STATUS<br/>The control status of the camera "
+            f"with url '{req_camera_url}' is <b>{control}</b>",
+            {'cameras': [camera_status(camera) for camera in cameras]})
+
+
+@app.route('/control/<string:status>', methods=['POST'])
+@basic_auth.required
+def activate_cameras(status):
+    """ Endpoint for switching multiple cameras between manual and automatic
+        camera control at once. The request body is a JSON document which
+        either lists camera URLs or agent identifiers like
+        `{"cameras": ["https://camera.example.com", "agent-id"]}` or selects
+        all cameras with `{"all": true}`.
+        No camera is switched if any of the listed cameras is unknown.
+        With `?wait=<seconds>`, the response is delayed until the cameras
+        reached their expected position.
+    """
+    if status not in ('manual', 'automatic'):
+        return jsonify({'error': f'Invalid status {status}'}), 400
+    try:
+        wait = wait_parameter()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    selection = request.get_json(silent=True)
+    if not isinstance(selection, dict):
+        return jsonify({'error': 'Invalid request body'}), 400
+
+    if selection.get('all') is True:
+        cameras = app.config['cameras']
+    else:
+        identifiers = selection.get('cameras')
+        if not isinstance(identifiers, list) or not identifiers:
+            return jsonify({'error': 'No cameras selected'}), 400
+        unknown = [identifier for identifier in identifiers
+                   if not find_cameras(str(identifier))]
+        if unknown:
+            return jsonify({'error': 'Cameras not found',
+                            'cameras': unknown}), 404
+        # Avoid switching cameras selected multiple times more than once
+        cameras = list({id(camera): camera
+                        for identifier in identifiers
+                        for camera in find_cameras(str(identifier))
+                        }.values())
+
+    logger.info('Switching %i cameras to %s control', len(cameras), status)
+    result = set_control(cameras, status, wait)
+    if result is None:
+        return jsonify({'error': 'Too many waiting requests'}), 503
+    return jsonify({'cameras': result})
+
+
+@app.route('/status')
+@basic_auth.required
+def view_status():
+    """ Endpoint for requesting the state of all cameras as a single JSON
+        document.
+    """
+    return jsonify({'cameras': [camera_status(camera)
+                                for camera in app.config['cameras']]})
 
 
 # expose camera control metrics
@@ -92,16 +265,28 @@ def view_current_camera_control_status(req_camera_url):
 def metrics():
     """ Endpoint for exposing the camera control metrics.
     """
-    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+    return Response(app.config['metrics'].get(),
+                    content_type=CONTENT_TYPE_LATEST)
 
 
 def start_camera_control_server(cameras, auth: tuple[str, str]):
-    """Start the flask server for managing the camera control
+    """Start the server for managing the camera control.
+    Requests are handled by a pool of worker threads.
     """
-    logger.info('Starting camera control server')
-    # start flask app
-    # ToDo get host and port from config, default 127.0.0.1:8000
+    host = config_t(str, 'server', 'host') or '127.0.0.1'
+    port = config_t(int, 'server', 'port') or 8080
+    threads = config_t(int, 'server', 'threads') or 8
+    metrics_cache = config_t(int, 'server', 'metrics_cache')
+    # Keep threads available for other requests by default
+    max_waiting = config_t(int, 'server', 'max_waiting') or \
+        max(threads // 2, 1)
+    logger.info('Starting camera control server on %s:%i with %i threads',
+                host, port, threads)
     app.config['cameras'] = cameras
+    app.config['camera_index'] = index_cameras(cameras)
+    app.config['waiting'] = threading.BoundedSemaphore(max_waiting)
+    app.config['metrics'] = CachedExposition(
+            1 if metrics_cache is None else metrics_cache)
     app.config['BASIC_AUTH_USERNAME'] = auth[0]
     app.config['BASIC_AUTH_PASSWORD'] = auth[1]
-    app.run(host='127.0.0.1', port=8080)
+    waitress.serve(app, host=host, port=port, threads=threads)
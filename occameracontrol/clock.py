@@ -0,0 +1,74 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from typing import Callable
+
+# Function returning the current time in seconds since the epoch
+_clock: Callable[[], float] = time.time
+
+
+def now() -> float:
+    '''Returns the current time used for all scheduling decisions like
+    whether an event is active or a preset needs to be re-sent. This is the
+    system time unless a different clock was set.
+    '''
+    return _clock()
+
+
+def set_clock(clock: Callable[[], float]):
+    '''Replace the clock used for scheduling decisions, e.g. by a virtual
+    clock for replaying a schedule faster than real time.
+
+    :param clock: Function returning the current time in seconds
+    '''
+    global _clock
+    _clock = clock
+
+
+class VirtualClock:
+    '''Clock which only advances when told to::
+
+        virtual = VirtualClock(start)
+        set_clock(virtual)
+        virtual.advance(60)
+    '''
+
+    def __init__(self, start: float):
+        '''Create a VirtualClock instance.
+
+        :param start: Initial time in seconds since the epoch
+        '''
+        self.time = start
+
+    def __call__(self) -> float:
+        return self.time
+
+    def advance(self, seconds: float):
+        '''Move the clock forward.
+
+        :param seconds: Number of seconds to advance the clock by
+        '''
+        self.time += max(seconds, 0)
+
+    def set(self, time: float):
+        '''Move the clock forward to a point in time. The clock never moves
+        backwards.
+
+        :param time: Time in seconds since the epoch
+        '''
+        self.time = max(self.time, time)
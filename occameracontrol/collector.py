@@ -0,0 +1,123 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from prometheus_client import REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+from occameracontrol import clock
+from occameracontrol.agent import Agent
+from occameracontrol.camera import Camera
+
+
+class StateCollector:
+    '''Collector reading the state of cameras and agents from the live
+    objects whenever the metrics are scraped, instead of updating gauges on
+    every camera move. The registry only requires a `collect()` method.
+    '''
+
+    def __init__(self, agents: list[Agent], cameras: list[Camera]):
+        '''Create a StateCollector instance.
+
+        :param agents: Capture agents to report
+        :param cameras: Cameras to report
+        '''
+        self.agents = agents
+        self.cameras = cameras
+
+    def collect(self):
+        '''Returns the metrics for the current state of all cameras and
+        agents.
+        '''
+        now = clock.now()
+        position = GaugeMetricFamily(
+                'camera_position',
+                'Last position (preset number) a camera moved to',
+                labels=('camera',))
+        expected = GaugeMetricFamily(
+                'camera_position_expected',
+                'The position (preset number) a camera should be in',
+                labels=('camera',))
+        control = GaugeMetricFamily(
+                'camera_control',
+                'Control status of a camera (1 if the status is active)',
+                labels=('camera', 'control'))
+        updated = GaugeMetricFamily(
+                'camera_last_updated_age',
+                'Seconds since the position of a camera was last updated',
+                labels=('camera',))
+        next_event = GaugeMetricFamily(
+                'agent_next_event_start',
+                'Start time of the current or next event of an agent',
+                labels=('agent',))
+
+        for camera in self.cameras:
+            if camera.position >= 0:
+                position.add_metric((camera.url,), camera.position)
+            expected_position = camera.expected_position()
+            if expected_position is not None:
+                expected.add_metric((camera.url,), expected_position)
+            for status in ('automatic', 'manual'):
+                control.add_metric((camera.url, status),
+                                   int(camera.control == status))
+            if camera.last_updated:
+                updated.add_metric((camera.url,), now - camera.last_updated)
+
+        for agent in self.agents:
+            if agent.calendar_initialized:
+                event = agent.next_event()
+                if event.start:
+                    next_event.add_metric((agent.agent_id,), event.start)
+
+        return [position, expected, control, updated, next_event]
+
+
+class CachedExposition:
+    '''Rendered metrics which are re-used for a short time, so that frequent
+    scrapes, e.g. by multiple Prometheus instances, are cheap.
+    '''
+
+    def __init__(self, max_age: float):
+        '''Create a CachedExposition instance.
+
+        :param max_age: Seconds to re-use the rendered metrics for
+        '''
+        self.max_age = max_age
+        self.rendered = b''
+        self.rendered_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> bytes:
+        '''Returns the rendered metrics, rendering them again if the cached
+        version is outdated.
+        '''
+        with self._lock:
+            if time.time() - self.rendered_at >= self.max_age:
+                self.rendered = generate_latest()
+                self.rendered_at = time.time()
+            return self.rendered
+
+
+def register_state_collector(agents: list[Agent], cameras: list[Camera]):
+    '''Register a collector reporting the state of the given cameras and
+    agents whenever the metrics are collected.
+
+    :param agents: Capture agents to report
+    :param cameras: Cameras to report
+    '''
+    REGISTRY.register(StateCollector(agents, cameras))
@@ -0,0 +1,175 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+from typing import Callable, Optional
+
+from occameracontrol import clock
+from occameracontrol.metrics import register_command_coalesced, \
+        register_command_queue, register_dispatch_latency
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command:
+    '''A command for a camera. Every command turns the camera on and, if a
+    preset is specified, moves it to that preset afterwards. If `verify` is
+    set, the camera is only moved if it is not at the preset already.
+
+    Commands are dispatched by their `priority` first and by the time they
+    are `due` second, e.g. the start of the event the command was sent for.
+    Commands without an explicit due time are due when they are submitted.
+    '''
+    __slots__ = ('preset', 'verify', 'priority', 'due', 'scheduled',
+                 'submitted')
+
+    def __init__(self, preset: Optional[int] = None, verify: bool = False,
+                 priority: int = 2, due: Optional[float] = None):
+        self.preset = preset
+        self.verify = verify
+        self.priority = priority
+        self.submitted = clock.now()
+        self.scheduled = due is not None
+        self.due = self.submitted if due is None else due
+
+    def sort_key(self) -> tuple[int, float]:
+        '''Returns the key for ordering commands for dispatching.
+        '''
+        return self.priority, self.due
+
+    def __str__(self) -> str:
+        if self.preset is None:
+            return 'power on'
+        if self.verify:
+            return f'verify preset {self.preset}'
+        return f'move to preset {self.preset}'
+
+
+class CommandQueue:
+    '''Pending commands for a single camera with latest-wins semantics.
+    There is at most one command pending while another one is being sent. A
+    newer command replaces the pending one and commands which are covered by
+    the pending or the currently sent command are dropped, so that a camera
+    never receives outdated presets.
+    '''
+    camera: str
+    pending: Optional[Command] = None
+    active: Optional[Command] = None
+    listeners: list[Callable[[], None]]
+
+    def __init__(self, camera: str):
+        '''Create a CommandQueue instance.
+
+        :param camera: Camera identifier used for metrics
+        '''
+        self.camera = camera
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback: Callable[[], None]):
+        '''Register a callback which is called whenever a new command is
+        queued.
+        '''
+        self.listeners.append(callback)
+
+    def covered(self, command: Command) -> bool:
+        '''Returns whether the command would have no effect in addition to
+        the pending or the active command. The caller needs to hold the lock.
+        '''
+        latest = self.pending or self.active
+        if not latest:
+            return False
+        # Every command turns the camera on
+        if command.preset is None:
+            return True
+        # Moving to a preset covers verifying the same preset
+        return command.preset == latest.preset and \
+            (command.verify or not latest.verify)
+
+    def put(self, command: Command):
+        '''Queue a command, replacing any pending command.
+        '''
+        with self._lock:
+            if self.covered(command):
+                return
+            if self.pending:
+                logger.debug('[%s] Replacing `%s` with `%s`',
+                             self.camera, self.pending, command)
+                register_command_coalesced(self.camera)
+            self.pending = command
+            self._update_metrics()
+        for callback in self.listeners:
+            callback()
+
+    def clear(self):
+        '''Drop the pending command. A command which is already being sent
+        is not affected.
+        '''
+        with self._lock:
+            if self.pending:
+                logger.debug('[%s] Dropping `%s`', self.camera, self.pending)
+            self.pending = None
+            self._update_metrics()
+
+    def target(self) -> Optional[int]:
+        '''Returns the preset of the latest command pending or being sent.
+        '''
+        latest = self.pending or self.active
+        return latest.preset if latest else None
+
+    def empty(self) -> bool:
+        '''Returns whether no command is pending or being sent.
+        '''
+        return self.pending is None and self.active is None
+
+    def peek(self) -> Optional[Command]:
+        '''Returns the pending command without taking it from the queue.
+        '''
+        return self.pending
+
+    def get(self) -> Optional[Command]:
+        '''Take the pending command for sending it to the camera. Returns
+        `None` if no command is pending. Call :meth:`done` once the command
+        was sent.
+        '''
+        with self._lock:
+            command, self.pending = self.pending, None
+            self.active = command
+            self._update_metrics(command)
+        return command
+
+    def done(self, sent: bool = True):
+        '''Mark the active command as finished.
+
+        :param sent: If the command was sent successfully
+        '''
+        with self._lock:
+            command, self.active = self.active, None
+            self._update_metrics()
+        # Only moves due at a specific time, like the start of an event, show
+        # how late cameras were moved. Moves ahead of time count as on time.
+        if sent and command and command.scheduled and not command.verify:
+            register_dispatch_latency(max(clock.now() - command.due, 0))
+
+    def _update_metrics(self, sent: Optional[Command] = None):
+        '''Update the queue metrics. The caller needs to hold the lock.
+        '''
+        depth = (self.pending is not None) + (self.active is not None)
+        age = clock.now() - sent.submitted if sent else None
+        register_command_queue(self.camera, depth, age)
@@ -0,0 +1,94 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from confygure import config_t
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    '''Global dispatcher limiting how many camera commands are sent at the
+    same time and how many are started per second. This prevents the network
+    and the camera web servers from being overwhelmed when many events start
+    at the same time. Waiting commands are dispatched by priority, so that
+    cameras with starting events are moved first.
+    '''
+
+    def __init__(self):
+        self.concurrency = config_t(int, 'dispatch', 'concurrency') or 32
+        rate = config_t(int, 'dispatch', 'rate')
+        self.interval = 1 / rate if rate else 0.0
+        # Heap of (priority, sequence number, callback)
+        self._heap: list[tuple[tuple, int, Callable[[], None]]] = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._next_dispatch = 0.0
+        self._condition = threading.Condition()
+
+    def request(self, priority: tuple, callback: Callable[[], None]):
+        '''Request to send a command. The callback is called from the
+        dispatcher thread once the command may be sent. :meth:`release` needs
+        to be called once the command has been sent.
+
+        :param priority: Commands with lower priority values are sent first
+        :param callback: Function to call once the command may be sent
+        '''
+        with self._condition:
+            heapq.heappush(self._heap,
+                           (priority, next(self._sequence), callback))
+            self._condition.notify()
+
+    def release(self):
+        '''Signal that a dispatched command has been sent.
+        '''
+        with self._condition:
+            self._running -= 1
+            self._condition.notify()
+
+    def wait_for_dispatch(self) -> Callable[[], None]:
+        '''Block until the next command may be sent and return its callback.
+        '''
+        with self._condition:
+            while True:
+                if not self._heap or self._running >= self.concurrency:
+                    self._condition.wait()
+                    continue
+
+                delay = self._next_dispatch - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                _, _, callback = heapq.heappop(self._heap)
+                self._running += 1
+                self._next_dispatch = time.time() + self.interval
+                return callback
+
+    def run(self):
+        '''Dispatcher loop granting permission to send commands.
+        '''
+        logger.info('Dispatching up to %i camera commands at once',
+                    self.concurrency)
+        while True:
+            self.wait_for_dispatch()()
@@ -15,10 +15,14 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import random
 import requests
+import threading
 import time
 
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
+from requests.adapters import HTTPAdapter
+from typing import Callable, Optional
 
 
 logger = logging.getLogger(__name__)
@@ -35,14 +39,191 @@ agent_calendar_update_time = Gauge(
         'agent_calendar_update_time',
         'Time of the last calendar update',
         ('agent',))
-camera_position = Gauge(
-        'camera_position',
-        'Last position (preset number) a camera moved to',
+agent_calendar_age = Gauge(
+        'agent_calendar_age',
+        'Seconds since the last successful calendar update',
+        ('agent',))
+agent_calendar_update_result = Counter(
+        'agent_calendar_update_result',
+        'Number of calendar updates which were applied or skipped since the '
+        'calendar did not change',
+        ('agent', 'result'))
+calendar_snapshot_age = Gauge(
+        'calendar_snapshot_age',
+        'Seconds since the calendar snapshot was last saved')
+startup_duration = Histogram(
+        'startup_duration',
+        'Seconds from starting the service until all agents were verified or '
+        'the startup timeout passed',
+        buckets=(.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf')))
+agent_verification_duration = Histogram(
+        'agent_verification_duration',
+        'Seconds it took to verify a capture agent in Opencast')
+camera_position_actual = Gauge(
+        'camera_position_actual',
+        'The position (preset number) a camera reported to be in',
+        ('camera',))
+camera_commands_suppressed = Counter(
+        'camera_commands_suppressed',
+        'Number of power commands not sent since the camera was known to be '
+        'in the requested power state already',
+        ('camera',))
+camera_dispatch_latency = Histogram(
+        'camera_dispatch_latency',
+        'Seconds from the start of an event until the camera was moved to its '
+        'active preset',
+        buckets=(.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, float('inf')))
+camera_commands_coalesced = Counter(
+        'camera_commands_coalesced',
+        'Number of queued camera commands replaced by a newer command before '
+        'they were sent',
         ('camera',))
-camera_position_expected = Gauge(
-        'camera_position_expected',
-        'The position (preset number) a camera should be in',
+camera_command_queue_depth = Gauge(
+        'camera_command_queue_depth',
+        'Number of camera commands pending or being sent',
         ('camera',))
+camera_command_age = Histogram(
+        'camera_command_age',
+        'Seconds camera commands were queued before they were sent')
+circuit_breaker_state = Gauge(
+        'circuit_breaker_state',
+        'State of the circuit breaker for a resource '
+        '(0 = closed, 1 = half-open, 2 = open)',
+        ('ressource',))
+camera_command_duration = Histogram(
+        'camera_command_duration',
+        'Seconds it took a camera to respond to a command',
+        ('camera', 'command'))
+calendar_fetch_duration = Histogram(
+        'calendar_fetch_duration',
+        'Seconds it took to fetch a calendar from Opencast',
+        ('calendar',))
+calendar_parse_duration = Histogram(
+        'calendar_parse_duration',
+        'Seconds it took to parse the events of an agent\'s calendar',
+        buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, float('inf')))
+control_loop_lag = Histogram(
+        'control_loop_lag',
+        'Seconds a control loop woke up later than scheduled',
+        ('loop',),
+        buckets=(.001, .005, .01, .05, .1, .5, 1, 5, float('inf')))
+http_requests = Counter(
+        'http_requests',
+        'Number of HTTP requests sent',
+        ('ressource',))
+http_connections = Counter(
+        'http_connections',
+        'Number of HTTP connections opened. Requests not opening a new '
+        'connection reused an existing one.',
+        ('ressource',))
+
+
+# Pre-computed children since the lag is recorded on every wake-up
+control_loop_lag_children = {
+        loop: control_loop_lag.labels(loop)
+        for loop in ('camera', 'scheduler')}
+
+
+class CommandMetrics():
+    '''Histograms of the command round-trip times of a single camera by
+    command type. The labeled children are created once, so that timing a
+    command does not need to look them up::
+
+        metrics = CommandMetrics('cam1')
+        with metrics.preset.time():
+            cam1.move_to_preset(1)
+    '''
+
+    def __init__(self, camera: str):
+        '''Create a CommandMetrics instance.
+
+        :param camera: Camera identifier
+        '''
+        self.power = camera_command_duration.labels(camera, 'power')
+        self.power_query = camera_command_duration.labels(
+                camera, 'power_query')
+        self.preset = camera_command_duration.labels(camera, 'preset')
+        self.position_query = camera_command_duration.labels(
+                camera, 'position_query')
+
+
+class CircuitBreaker():
+    '''Circuit breaker for requests to a resource which may be unreachable.
+    After a number of consecutive failures, the circuit opens and no further
+    requests should be sent until an exponentially increasing, jittered delay
+    has passed. Then, a single request may probe the resource. If it
+    succeeds, the circuit closes again. Otherwise it opens with a longer
+    delay. Use this with a :class:`RequestErrorHandler`::
+
+        breaker = CircuitBreaker('cam1')
+        handler = RequestErrorHandler('cam1', 'Unable to connect', breaker)
+        if breaker.allow():
+            with handler:
+                cam1.update()
+    '''
+
+    states = {'closed': 0, 'half-open': 1, 'open': 2}
+
+    def __init__(self, ressource: str, threshold: int = 3,
+                 max_delay: float = 300):
+        '''Create a CircuitBreaker instance.
+
+        :param ressource: Identifier of the resource
+        :param threshold: Number of consecutive failures opening the circuit
+        :param max_delay: Maximum delay in seconds before probing again
+        '''
+        self.ressource = ressource
+        self.threshold = threshold
+        self.max_delay = max_delay
+        self.failures = 0
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+        self._set_state('closed')
+
+    def _set_state(self, state: str):
+        self.state = state
+        circuit_breaker_state.labels(self.ressource).set(self.states[state])
+
+    def allow(self) -> bool:
+        '''Returns whether a request should be sent. If the circuit is open
+        and the delay has passed, this lets a single probe request through.
+        '''
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() >= self.retry_at:
+                self._set_state('half-open')
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        '''Returns the number of seconds to wait before the next request after
+        a failure. This is at least one second.
+        '''
+        return max(self.retry_at - time.time(), 1)
+
+    def success(self):
+        '''Record a successful request, closing the circuit.
+        '''
+        with self._lock:
+            self.failures = 0
+            if self.state != 'closed':
+                logger.info('%s is reachable again', self.ressource)
+                self._set_state('closed')
+
+    def failure(self):
+        '''Record a failed request, opening the circuit if necessary.
+        '''
+        with self._lock:
+            self.failures += 1
+            if self.state == 'closed' and self.failures < self.threshold:
+                return
+            delay = min(2 ** (self.failures - self.threshold), self.max_delay)
+            # Jitter only spreads the retries, no cryptographic randomness
+            # needed
+            jitter = random.uniform(0.8, 1.2)  # nosec B311
+            self.retry_at = time.time() + delay * jitter
+            self._set_state('open')
 
 
 class RequestErrorHandler():
@@ -58,18 +239,22 @@ class RequestErrorHandler():
     '''
 
     err_msg_only = (
+            LookupError,
             requests.exceptions.ConnectionError,
             requests.exceptions.HTTPError,
             requests.exceptions.ReadTimeout)
 
-    def __init__(self, resource, message):
+    def __init__(self, resource, message,
+                 breaker: Optional[CircuitBreaker] = None):
         '''Create a RequestErrorHandler instance.
 
         :param ressource: Identifier of the resource
         :param message: Message to log in case of an error
+        :param breaker: Circuit breaker to record successes and failures in
         '''
         self.resource = resource
         self.message = message
+        self.breaker = breaker
 
     def __enter__(self):
         return self
@@ -78,41 +263,188 @@ class RequestErrorHandler():
         '''Handler for then exiting the `with` block. Takes care of catching
         errors, logging them and updating the metrics.
         '''
+        message = self.message
+        if self.breaker:
+            # Errors about missing resources mean the resource is reachable
+            if exc_type is None or issubclass(exc_type, LookupError):
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+                if self.breaker.state == 'open':
+                    message += ' (retrying in %.0f seconds)' % \
+                            self.breaker.retry_in()
         if exc_type in self.err_msg_only:
-            logger.error('%s: %s', self.message, exc_value)
+            logger.error('%s: %s', message, exc_value or exc_type.__name__)
             request_errors.labels(self.resource, exc_type.__name__).inc()
         elif exc_type:
-            logger.exception(self.message)
+            logger.exception(message)
             request_errors.labels(self.resource, exc_type.__name__).inc()
         # Silence Exception types
         return exc_type is None or issubclass(exc_type, Exception)
 
 
-def register_calendar_update(agent_id: str):
-    '''Update metrics for when a calendar update happened. This updates both
-    the metrics for successful updates and the time of the last update.
+class ConnectionMetricsAdapter(HTTPAdapter):
+    '''HTTP adapter for `requests` sessions keeping track of how many requests
+    were sent and how many new connections had to be opened for them::
+
+        session = requests.Session()
+        session.mount('http://', ConnectionMetricsAdapter('cam1'))
+    '''
+
+    def __init__(self, ressource: str, **kwargs):
+        '''Create a ConnectionMetricsAdapter instance.
+
+        :param ressource: Identifier of the resource
+        '''
+        self.ressource = ressource
+        super().__init__(**kwargs)
+
+    def connections(self) -> int:
+        '''Returns the number of connections opened by this adapter so far.
+        '''
+        pools = self.poolmanager.pools
+        return sum(pool.num_connections
+                   for pool in map(pools.get, pools.keys()) if pool)
+
+    def send(self, request, *args, **kwargs):
+        '''Send the request and update the connection metrics.
+        '''
+        connections = self.connections()
+        response = super().send(request, *args, **kwargs)
+        register_http_request(self.ressource,
+                              self.connections() > connections)
+        return response
+
+
+def register_calendar_update(agent_id: str, applied: bool = True):
+    '''Update metrics for when a calendar update happened. This updates the
+    metrics for successful updates, the time of the last update and whether
+    the update was applied or skipped because the calendar did not change.
 
     :param agent_id: Capture agent identifier
+    :param applied: If the calendar changed and the update was applied
     '''
     agent_calendar_update_total.labels(agent_id).inc()
     agent_calendar_update_time.labels(agent_id).set(time.time())
+    result = 'applied' if applied else 'skipped'
+    agent_calendar_update_result.labels(agent_id, result).inc()
+
 
+def calendar_fetch_metric(calendar: str) -> Histogram:
+    '''Returns the histogram child for timing calendar requests. Create this
+    once per calendar and use it with `with metric.time(): …`.
+
+    :param calendar: Capture agent identifier or `all` for bulk requests
+    '''
+    return calendar_fetch_duration.labels(calendar)
 
-def register_camera_move(camera: str, position: int):
-    '''Update metrics for when a camera move has happened. This ensures the
-    position of the camera is available as part of the metrics.
+
+def register_calendar_parse(duration: float):
+    '''Update metrics for when the events of a calendar were parsed.
+
+    :param duration: Time parsing the calendar took in seconds
+    '''
+    calendar_parse_duration.observe(duration)
+
+
+def register_loop_lag(loop: str, lag: float):
+    '''Update metrics for when a control loop woke up.
+
+    :param loop: Type of the loop (`camera` or `scheduler`)
+    :param lag: Seconds the loop woke up later than scheduled
+    '''
+    control_loop_lag_children[loop].observe(max(lag, 0))
+
+
+def register_calendar_age(agent_id: str, calendar_age: Callable[[], float]):
+    '''Register a function returning the age of an agent's calendar which is
+    evaluated whenever the metrics are collected.
+
+    :param agent_id: Capture agent identifier
+    :param calendar_age: Function returning the calendar age in seconds
+    '''
+    agent_calendar_age.labels(agent_id).set_function(calendar_age)
+
+
+def register_snapshot_age(snapshot_age: Callable[[], float]):
+    '''Register a function returning the age of the calendar snapshot which
+    is evaluated whenever the metrics are collected.
+
+    :param snapshot_age: Function returning the snapshot age in seconds
+    '''
+    calendar_snapshot_age.set_function(snapshot_age)
+
+
+def register_startup(duration: float):
+    '''Update metrics for when the startup of the service finished.
+
+    :param duration: Startup time in seconds
+    '''
+    startup_duration.observe(duration)
+
+
+def register_agent_verification(duration: float):
+    '''Update metrics for when the verification of an agent finished.
+
+    :param duration: Time the verification took in seconds
+    '''
+    agent_verification_duration.observe(duration)
+
+
+def register_camera_actual(camera: str, position: int):
+    '''Update metrics for when a camera reported its position.
+
+    :param camera: Camera identifier
+    :param position: Reported camera position
+    '''
+    camera_position_actual.labels(camera).set(position)
+
+
+def register_command_suppressed(camera: str):
+    '''Update metrics for when a power command was not sent to a camera
+    since it was known to be in the requested state already.
+
+    :param camera: Camera identifier
+    '''
+    camera_commands_suppressed.labels(camera).inc()
+
+
+def register_dispatch_latency(latency: float):
+    '''Update metrics for when a camera was moved to its active preset.
+
+    :param latency: Seconds since the start of the event
+    '''
+    camera_dispatch_latency.observe(latency)
+
+
+def register_command_coalesced(camera: str):
+    '''Update metrics for when a queued camera command was replaced by a
+    newer command.
 
     :param camera: Camera identifier
-    :param position: New camera position
     '''
-    camera_position.labels(camera).set(position)
+    camera_commands_coalesced.labels(camera).inc()
 
 
-def register_camera_expectation(camera: str, position: int):
-    '''Update metrics for when a camera is supposed to move. This ensures the
-    position the camera is expected in is available as part of the metrics.
+def register_command_queue(camera: str, depth: int,
+                           age: Optional[float] = None):
+    '''Update metrics for when the command queue of a camera changed.
 
     :param camera: Camera identifier
-    :param position: New camera position
+    :param depth: Number of commands pending or being sent
+    :param age: Seconds the command taken from the queue was waiting
+    '''
+    camera_command_queue_depth.labels(camera).set(depth)
+    if age is not None:
+        camera_command_age.observe(age)
+
+
+def register_http_request(ressource: str, new_connection: bool):
+    '''Update metrics for when an HTTP request was sent.
+
+    :param ressource: Identifier of the resource
+    :param new_connection: If a new connection was opened for the request
     '''
-    camera_position_expected.labels(camera).set(position)
+    http_requests.labels(ressource).inc()
+    if new_connection:
+        http_connections.labels(ressource).inc()
@@ -0,0 +1,104 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import logging
+import threading
+
+from occameracontrol import clock
+from occameracontrol.agent import Agent
+from occameracontrol.metrics import register_loop_lag
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    '''Timer heap keeping track of the next state transition (start or end of
+    an event) of all agents. Instead of the cameras polling their agent's
+    calendar, the scheduler notifies the subscribers of an agent exactly when
+    the agent's state changes.
+    '''
+
+    def __init__(self):
+        # Heap of (transition time, agent identifier). Entries are removed
+        # lazily, only the time stored in `_due` is valid for an agent.
+        self._heap: list[tuple[float, str]] = []
+        self._due: dict[str, float] = {}
+        self._agents: dict[str, Agent] = {}
+        self._condition = threading.Condition()
+
+    def add(self, agent: Agent):
+        '''Add an agent whose state transitions should be tracked.
+        '''
+        self._agents[agent.agent_id] = agent
+        agent.subscribe(lambda: self.reschedule(agent))
+        self.reschedule(agent)
+
+    def reschedule(self, agent: Agent):
+        '''Update the time of the next state transition of an agent, e.g.
+        after its calendar has changed.
+        '''
+        when = agent.next_transition()
+        with self._condition:
+            if self._due.get(agent.agent_id) == when:
+                return
+            if when is None:
+                del self._due[agent.agent_id]
+                return
+            logger.debug('[%s] Next state transition at %.3f',
+                         agent.agent_id, when)
+            self._due[agent.agent_id] = when
+            heapq.heappush(self._heap, (when, agent.agent_id))
+            self._condition.notify()
+
+    def wait_for_transitions(self) -> list[Agent]:
+        '''Block until at least one agent reaches its next state transition
+        and return all agents whose state has changed.
+        '''
+        with self._condition:
+            while True:
+                # Drop outdated entries
+                while self._heap and \
+                        self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                delay = self._heap[0][0] - clock.now()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                agents = []
+                now = clock.now()
+                while self._heap and self._heap[0][0] <= now:
+                    when, agent_id = heapq.heappop(self._heap)
+                    if self._due.get(agent_id) == when:
+                        del self._due[agent_id]
+                        agents.append(self._agents[agent_id])
+                        register_loop_lag('scheduler', now - when)
+                return agents
+
+    def run(self):
+        '''Scheduler loop notifying agents about their state transitions.
+        '''
+        while True:
+            for agent in self.wait_for_transitions():
+                logger.debug('[%s] State transition', agent.agent_id)
+                agent.notify()
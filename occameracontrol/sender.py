@@ -0,0 +1,133 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from occameracontrol.camera import Camera
+from occameracontrol.dispatcher import Dispatcher
+from occameracontrol.metrics import RequestErrorHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+class CommandSender:
+    '''Sends the queued commands of all cameras with a bounded pool of worker
+    threads once the dispatcher allows it, instead of using a sender thread
+    per camera. At most one command per camera is dispatched or sent at a
+    time. Failed commands are not retried here. Instead, the control loop of
+    the camera is notified after a back-off to decide which command to send
+    next.
+    '''
+
+    def __init__(self, dispatcher: Dispatcher):
+        '''Create a CommandSender instance.
+
+        :param dispatcher: Dispatcher granting permission to send commands
+        '''
+        self.dispatcher = dispatcher
+        # One worker per command the dispatcher lets through at once
+        self._executor = ThreadPoolExecutor(
+                max_workers=dispatcher.concurrency,
+                thread_name_prefix='sender')
+        self._error_handlers: dict[str, RequestErrorHandler] = {}
+        # Cameras with a command dispatched, being sent or backing off
+        self._busy: set[str] = set()
+        # Heap of (end of back-off, sequence number, camera)
+        self._backoff: list[tuple[float, int, Camera]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def add(self, camera: Camera):
+        '''Start sending the commands queued for a camera.
+        '''
+        self._error_handlers[camera.url] = RequestErrorHandler(
+                camera.url,
+                f'Failed to communicate with camera {camera}',
+                camera.breaker)
+        camera.commands.subscribe(lambda: self.request(camera))
+        # Commands may have been queued before subscribing
+        self.request(camera)
+
+    def request(self, camera: Camera):
+        '''Request dispatching the pending command of a camera unless another
+        command of the camera is dispatched, sent or backing off already.
+        '''
+        with self._condition:
+            pending = camera.commands.peek()
+            if not pending or camera.url in self._busy:
+                return
+            self._busy.add(camera.url)
+
+        def dispatch():
+            self._executor.submit(self.send, camera)
+
+        # Take the command only when it is dispatched, so that it can still
+        # be replaced by a newer command while waiting
+        self.dispatcher.request(pending.sort_key(), dispatch)
+
+    def send(self, camera: Camera):
+        '''Send the pending command of a camera. This is run by the workers.
+        '''
+        command = camera.commands.get()
+        failed = True
+        with self._error_handlers[camera.url]:
+            if command:
+                camera.execute(command)
+            failed = False
+        self.dispatcher.release()
+        if failed:
+            # The camera may have been restarted
+            camera.set_power(None)
+            # Back off while the camera is unreachable. The command stays
+            # active meanwhile, so that the control loop keeps waiting.
+            retry_at = time.time() + camera.breaker.retry_in()
+            with self._condition:
+                heapq.heappush(self._backoff,
+                               (retry_at, next(self._sequence), camera))
+                self._condition.notify()
+            return
+        self.finish(camera, sent=True)
+
+    def finish(self, camera: Camera, sent: bool):
+        '''Mark the active command of a camera as finished and continue with
+        the next pending command.
+        '''
+        camera.commands.done(sent=sent)
+        with self._condition:
+            self._busy.discard(camera.url)
+        # Let the control loop decide about the next command
+        camera.notify()
+        self.request(camera)
+
+    def run(self):
+        '''Loop finishing failed commands once their back-off has passed.
+        '''
+        while True:
+            with self._condition:
+                while not self._backoff \
+                        or self._backoff[0][0] > time.time():
+                    timeout = self._backoff[0][0] - time.time() \
+                        if self._backoff else None
+                    self._condition.wait(timeout)
+                _, _, camera = heapq.heappop(self._backoff)
+            self.finish(camera, sent=False)
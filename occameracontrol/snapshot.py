@@ -0,0 +1,137 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from confygure import config_t
+from typing import Optional
+
+from occameracontrol.agent import Agent, Event
+from occameracontrol.metrics import register_snapshot_age
+
+
+logger = logging.getLogger(__name__)
+
+
+class CalendarSnapshot:
+    '''Local copy of the last calendars successfully received from Opencast.
+    Loading the snapshot at startup allows cameras to act on the cached
+    schedule right away, even if Opencast is slow or unavailable.
+    '''
+    path: str
+    agents: list[Agent]
+    saved: float = 0.0
+    # Seconds between checks whether the snapshot needs to be saved
+    interval: int = 60
+    # Calendars of all agents at the time the snapshot was last saved
+    saved_hashes: dict[str, Optional[bytes]]
+
+    def __init__(self, path: str, agents: list[Agent]):
+        self.path = os.path.expanduser(path)
+        self.agents = agents
+        self.saved_hashes = {}
+        self.interval = config_t(int, 'calendar', 'snapshot_interval') or 60
+        self._lock = threading.Lock()
+        register_snapshot_age(self.age)
+
+    def age(self) -> float:
+        '''Returns the number of seconds since the snapshot was last saved.
+        '''
+        return time.time() - self.saved
+
+    def load(self):
+        '''Load the calendars of all agents from the snapshot file.
+        '''
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+            saved = float(snapshot['saved'])
+            calendars = snapshot['agents']
+            restored = {}
+            for agent in self.agents:
+                if agent.agent_id not in calendars:
+                    continue
+                calendar = calendars[agent.agent_id]
+                events = [Event(sys.intern(title), float(start), float(end))
+                          for title, start, end in calendar['events']]
+                restored[agent.agent_id] = (events, float(calendar['updated']))
+        except FileNotFoundError:
+            logger.info('No calendar snapshot found at %s', self.path)
+            return
+        except (OSError, LookupError, TypeError, ValueError) as e:
+            # Start without the snapshot rather than failing on a broken one
+            logger.warning('Failed to load calendar snapshot: %s', e)
+            return
+
+        self.saved = saved
+        for agent in self.agents:
+            if agent.agent_id in restored:
+                agent.restore_events(*restored[agent.agent_id])
+        self.saved_hashes = {agent.agent_id: agent.calendar_hash
+                             for agent in self.agents}
+        logger.info('Loaded calendar snapshot from %s (%.0f seconds old)',
+                    self.path, self.age())
+
+    def run(self):
+        '''Loop saving the snapshot periodically if any calendar changed.
+        Saving once per interval instead of after every calendar update keeps
+        the number of writes independent of the number of agents.
+        '''
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def save(self):
+        '''Save the calendars of all agents to the snapshot file if any
+        calendar changed since the snapshot was last saved.
+        '''
+        # Calendars may be updated from several threads at once
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        '''Save the snapshot. The caller needs to hold the lock.
+        '''
+        hashes = {agent.agent_id: agent.calendar_hash for agent in self.agents}
+        if hashes == self.saved_hashes:
+            return
+
+        snapshot = {
+            'saved': time.time(),
+            'agents': {
+                agent.agent_id: {
+                    'updated': agent.calendar_updated,
+                    'events': [(e.title, e.start, e.end)
+                               for e in agent.events]}
+                for agent in self.agents if agent.calendar_initialized}}
+        try:
+            # Write to a temporary file first to never leave a broken snapshot
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error('Failed to save calendar snapshot: %s', e)
+            return
+
+        self.saved = snapshot['saved']
+        self.saved_hashes = hashes
+        logger.debug('Saved calendar snapshot to %s', self.path)
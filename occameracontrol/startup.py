@@ -0,0 +1,98 @@
+# Opencast Camera Control
+# Copyright 2024 Osnabrück University, virtUOS
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from confygure import config_t
+
+from occameracontrol.agent import Agent
+from occameracontrol.metrics import register_agent_verification, \
+        register_startup
+
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    '''Keeps track of the verification of all agents during startup.
+    Agents are verified independently of each other and startup is finished
+    once all agents are verified or the startup timeout has passed. Agents
+    which could not be verified by then are still retried in the background.
+    '''
+
+    def __init__(self, agents: list[Agent], started: float):
+        '''Create a Startup instance.
+
+        :param agents: Agents which need to be verified
+        :param started: Time the service was started
+        '''
+        self.started = started
+        self.pending = {agent.agent_id for agent in agents}
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def timeout(self) -> float:
+        '''Returns the number of seconds after which startup is finished,
+        even if not all agents could be verified.
+        '''
+        return config_t(int, 'startup_timeout') or 60
+
+    def verified(self, agent: Agent, duration: float):
+        '''Record the successful verification of an agent.
+
+        :param agent: Agent which was verified
+        :param duration: Time the verification took in seconds
+        '''
+        register_agent_verification(duration)
+        with self._lock:
+            self.pending.discard(agent.agent_id)
+            done = not self.pending
+        if done:
+            self.finish()
+
+    def failed(self, agent: Agent, duration: float, attempt: int) -> float:
+        '''Record a failed verification of an agent and return the number of
+        seconds after which the verification should be retried.
+
+        :param agent: Agent whose verification failed
+        :param duration: Time the verification took in seconds
+        :param attempt: Number of failed verification attempts so far
+        '''
+        register_agent_verification(duration)
+        delay = min(2 ** attempt, 300)
+        logger.warning('Retrying verification of agent `%s` in %i seconds',
+                       agent.agent_id, delay)
+        return delay
+
+    def finish(self):
+        '''Mark the startup as finished. This is a no-op if it was finished
+        before.
+        '''
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            pending = sorted(self.pending)
+        duration = time.time() - self.started
+        register_startup(duration)
+        if pending:
+            logger.warning('Startup finished after %.1f seconds with %i '
+                           'unverified agents: %s',
+                           duration, len(pending), ', '.join(pending))
+        else:
+            logger.info('Startup finished after %.1f seconds', duration)